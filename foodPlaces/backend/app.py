@@ -2,66 +2,820 @@
 ''' 
 City function
 - show_all_cities()
-- show_one_city(city_id)
+- show_one_city(city_id) (places filtered and paged in the database)
 - create_new_city()
 - update_city(city_id)
 - delete_city(city_id)
 
-Place function
+Place function (places collection, keyed by city_id)
 - show_all_places
+- show_places (across cities)
+- show_top_places (by Bayesian score)
+- show_place_facets (filter option counts)
+- show_flag_counts (flag combinations, from in-memory bitmaps)
+- show_places_near (across cities, by distance)
+- search_places (across cities, by text relevance)
+- autocomplete (city and place names, from memory)
 - show_one_place
 - add_new_place
 - update_place
 - delete_place
+- bulk_import_places (NDJSON, also the import-places command)
 - update_place_status
 
-Review function
+Review function (reviews collection, keyed by place_id)
 - show_all_reviews
 - show_one_review
 - add_new_review
 - update_review
 - delete_review
-- update_place_rating
+- bulk_import_reviews (NDJSON across places, also the import-reviews command)
+- update_place_rating (full recount, review writes keep rating_sum/review_count up to date)
 '''
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, g
+from flask.json.provider import DefaultJSONProvider
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne, ReplaceOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import jwt
 import datetime
 from functools import wraps
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import time
 import bcrypt
+import base64
+import bisect
+import hashlib
+import json
+import re
+from zoneinfo import ZoneInfo
 from flask_cors import CORS
+import click
+try: # Faster JSON encoding when orjson is installed
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 CORS(app)
 app.config['SECRET_KEY'] = 'secretKey' # Key for jwt
+app.config['CACHE_MAX_ENTRIES'] = 1024 # Most GET responses kept in memory
+app.config['CACHE_TTL_SECONDS'] = 60 # How long a cached GET response stays valid
+app.config['REVOCATION_SYNC_SECONDS'] = 5 # How often revoked tokens are read back from the blacklist
+app.config['TOKEN_CACHE_MAX_ENTRIES'] = 1024 # Most verified tokens kept with their claims
+app.config['BCRYPT_ROUNDS'] = 12 # bcrypt cost, older hashes are redone on login when this changes
+app.config['BCRYPT_WORKERS'] = 2 # Processes hashing passwords
+app.config['BCRYPT_MAX_PENDING'] = 32 # Hashes queued or running before requests get a 503
+app.config['BCRYPT_TIMEOUT_SECONDS'] = 10 # Longest a request waits for its hash before getting a 503
+app.config['LOGIN_USERNAME_BUCKET'] = (5, 5 / 60) # Login/register attempts per username: burst, tokens per second
+app.config['LOGIN_IP_BUCKET'] = (20, 20 / 60) # Login/register attempts per client IP: burst, tokens per second
+app.config['RATE_LIMIT_MAX_KEYS'] = 10000 # Most buckets kept by each limiter
+app.config['SCORE_PRIOR_MEAN'] = 3.5 # Rating a place is assumed to have before its reviews come in
+app.config['SCORE_PRIOR_WEIGHT'] = 10 # How many reviews the assumed rating counts as
+app.config['PLACES_TIMEZONE'] = 'Europe/London' # Time zone of the business hours, used by open_now and open_at
+app.config['IMPORT_BATCH_SIZE'] = 500 # Places or reviews written per bulk write when importing
+app.config['MONGO_STARTUP_TIMEOUT_MS'] = 5000 # How long index setup waits for MongoDB before failing
+app.config['AUTOCOMPLETE_REFRESH_SECONDS'] = 300 # How often the name index is rebuilt to pick up other processes' writes
 
 ''''''
 # MongoDB Connection
 ''''''
-client = MongoClient("mongodb://127.0.0.1:27017")
+MONGO_URI = "mongodb://127.0.0.1:27017"
+client = MongoClient(MONGO_URI)
 db = client.foodPlacesDB # Database
 businesses = db.foodPlaces # Collection
+places_collection = db.places # One document per place, keyed by city_id
+reviews_collection = db.reviews # One document per review, keyed by place_id
 users = db.users
 blacklist = db.blacklist
 
+RECENT_REVIEWS_LIMIT = 10 # Latest reviews kept on each place for the place page
+RECENT_REVIEWS = {"$ifNull": ["$ratings.recent_reviews", []]} # Recent reviews inside an update pipeline
+
+# Fields returned for a review
+REVIEW_PROJECTION = {"place_id": 0, "city_id": 0}
+
+# Fields returned for a place, leaving out internal bookkeeping
+PLACE_PROJECTION = {"ratings.rating_sum": 0, "type_keys": 0}
+
+# Fields returned for each place of a city
+CITY_PLACE_PROJECTION = {
+    "place_id": 1, "info": 1, "location": 1, "business_hours": 1, "service_options": 1, "menu_options": 1,
+    "amenities": 1, "ratings.average_rating": 1, "ratings.review_count": 1, "ratings.recent_reviews": 1, "media": 1
+}
+
+''''''
+# Indexes
+''''''
+# Fields searched by /api/search and how much a match in each counts
+TEXT_WEIGHTS = {
+    "info.name": 10,
+    "info.type": 5,
+    "location.address.street": 2,
+    "location.address.city": 2,
+    "location.address.postcode": 2,
+    "location.address.full_address": 2,
+    "ratings.recent_reviews.content": 1
+}
+
+# Indexes the app relies on: (collection, keys, options)
+INDEXES = [
+    (users, [("username", ASCENDING)], {"name": "username_unique", "unique": True}), # Login and register lookups
+    (users, [("email", ASCENDING)], {"name": "email_unique", "unique": True}), # Register lookup
+    (blacklist, [("token", ASCENDING)], {"name": "token"}), # Per-request revocation check
+    (blacklist, [("exp", ASCENDING)], {"name": "exp_ttl", "expireAfterSeconds": 0}), # Drops entries once the token expires
+    (businesses, [("city_name", ASCENDING), ("_id", ASCENDING)], {"name": "city_name"}), # City list sort and cursor
+    (places_collection, [("city_id", ASCENDING), ("type_keys", ASCENDING), ("ratings.average_rating", DESCENDING)],
+        {"name": "city_type_key_rating"}), # Type/rating filters within a city
+    (places_collection, [("city_id", ASCENDING), ("info.name", ASCENDING), ("_id", ASCENDING)],
+        {"name": "city_name_sort"}), # Name sort and cursor within a city
+    (places_collection, [("type_keys", ASCENDING), ("ratings.average_rating", DESCENDING)],
+        {"name": "type_key_rating"}), # Type/rating filters across cities
+    (places_collection, [("info.name", ASCENDING), ("_id", ASCENDING)],
+        {"name": "name_sort"}), # Name sort and cursor across cities
+    (places_collection, [("ratings.average_rating", DESCENDING), ("_id", DESCENDING)],
+        {"name": "rating_sort"}), # Rating sort, filter and cursor across cities
+    (places_collection, [("ratings.review_count", DESCENDING), ("_id", DESCENDING)],
+        {"name": "review_count_sort"}), # Review count sort and cursor across cities
+    (places_collection, [("city_id", ASCENDING), ("ratings.score", DESCENDING), ("_id", DESCENDING)],
+        {"name": "city_score"}), # Score sort, cursor and top places within a city
+    (places_collection, [("ratings.score", DESCENDING), ("_id", DESCENDING)],
+        {"name": "score_sort"}), # Score sort and cursor across cities
+    (places_collection, [("location.point", "2dsphere")], {"name": "location_point"}), # Places near a position
+    (places_collection, [("city_id", ASCENDING), ("open_intervals.start", ASCENDING), ("open_intervals.end", ASCENDING)],
+        {"name": "city_open"}), # Open now/at within a city
+    (places_collection, [("open_intervals.start", ASCENDING), ("open_intervals.end", ASCENDING)],
+        {"name": "open_intervals"}), # Open now/at across cities
+    (places_collection, [(field, "text") for field in TEXT_WEIGHTS], {
+        "name": "place_text", "weights": TEXT_WEIGHTS,
+        "language_override": "text_language" # Reviews carry their own language field, don't let it pick the stemmer
+    }), # Search across names, types, addresses and recent review content
+    (reviews_collection, [("place_id", ASCENDING), ("date_posted", DESCENDING), ("_id", DESCENDING)],
+        {"name": "place_date"}), # Date sort, range filters and cursor
+    (reviews_collection, [("place_id", ASCENDING), ("rating", DESCENDING), ("_id", DESCENDING)],
+        {"name": "place_rating"}), # Rating sort, filter and cursor
+    (reviews_collection, [("place_id", ASCENDING), ("review_id", ASCENDING)],
+        {"name": "place_review_id"}) # Matching re-sent reviews to the stored ones
+]
+
+# Index options compared when checking for drift
+INDEX_OPTIONS = ["unique", "expireAfterSeconds", "weights"]
+
+# Creates the declared indexes, then reports any drift from what exists.
+# Unique and TTL indexes are relied on for correctness, so failing to build one stops the app
+def create_indexes():
+    try: # Fail fast when MongoDB is down instead of waiting out the server selection timeout on every index
+        with MongoClient(MONGO_URI, serverSelectionTimeoutMS=app.config['MONGO_STARTUP_TIMEOUT_MS']) as probe:
+            probe.admin.command("ping")
+    except PyMongoError as err:
+        raise RuntimeError(f"MongoDB is not reachable: {err}")
+    failed = [] # Required indexes that could not be built
+    for collection, keys, options in INDEXES: # For each declared index
+        try: # Existing data can stop an index being built
+            collection.create_index(keys, **options)
+        except Exception as err: # Keep going, the drift check reports it
+            print(f"Could not create index {collection.name}.{options['name']}: {err}")
+            if options.get("unique") or "expireAfterSeconds" in options: # Needed for correctness
+                failed.append(f"{collection.name}.{options['name']}: {err}")
+    check_index_drift()
+    if failed: # Don't serve without them
+        raise RuntimeError("Could not create required indexes: " + "; ".join(failed))
+
+# Logs differences between the declared indexes and the ones in the database
+def check_index_drift():
+    drift = [] # Drift messages
+    for collection in {id(c): c for c, _, _ in INDEXES}.values(): # Each indexed collection once
+        declared = {options["name"]: (keys, options) for c, keys, options in INDEXES if c is collection}
+        existing = collection.index_information() # Indexes in the database
+        for name, (keys, options) in declared.items(): # Declared indexes
+            if name not in existing: # Missing index
+                drift.append(f"{collection.name}.{name} is missing")
+                continue
+            existing_keys = [(field, direction) for field, direction in existing[name]["key"]]
+            if existing_keys[:1] == [("_fts", "text")]: # Text index, its fields are listed in the weights
+                existing_keys = sorted((field, "text") for field in existing[name].get("weights", {}))
+                keys = sorted(keys)
+            if existing_keys != keys: # Different keys
+                drift.append(f"{collection.name}.{name} has keys {existing[name]['key']}, expected {keys}")
+            for option in INDEX_OPTIONS: # Different options
+                if existing[name].get(option) != options.get(option):
+                    drift.append(f"{collection.name}.{name} has {option}={existing[name].get(option)}, expected {options.get(option)}")
+        for name in existing: # Indexes nobody declared
+            if name != "_id_" and name not in declared:
+                drift.append(f"{collection.name}.{name} exists but is not declared")
+    for message in drift: # Log each difference
+        print(f"Index drift: {message}")
+    return drift
+
+indexes_ready = threading.Event() # Set once this process has built and checked the indexes
+indexes_lock = threading.Lock()
+
+# Builds and checks the indexes once per process, not on import so pool workers and failed connections don't repeat it
+def ensure_indexes():
+    if indexes_ready.is_set(): # Already done
+        return
+    with indexes_lock: # One thread builds them
+        if not indexes_ready.is_set():
+            create_indexes()
+            indexes_ready.set()
+
+# Indexes are in place before the first request is served, under flask run and WSGI servers alike
+@app.before_request
+def require_indexes():
+    try:
+        ensure_indexes()
+    except Exception as err: # Don't serve without the required indexes, tried again on the next request
+        print(f"Index setup failed: {err}")
+        return make_response(jsonify({"error": "Service unavailable", "message": str(err)}), 503)
+
 ''''''
 # Helpers
 ''''''
-# Convert ObjectId fields to strings for JSON
-def convert_objectid_to_str(document):
-    if isinstance(document, list):  # If it's a list, process each item
-        return [convert_objectid_to_str(item) for item in document]
-    elif isinstance(document, dict):  # If it's a dict, process each key-value pair
-        return {
-            key: convert_objectid_to_str(value) if isinstance(value, (dict, list)) else str(value) if isinstance(value, ObjectId) else value
-            for key, value in document.items()
+# JSON provider that writes ObjectId and datetime values during the one serialization pass
+class MongoJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(value): # Called only for values JSON can't encode itself
+        if isinstance(value, ObjectId): # ObjectIds become strings
+            return str(value)
+        if isinstance(value, datetime.datetime): # Datetimes become ISO 8601 strings
+            return value.isoformat()
+        return DefaultJSONProvider.default(value)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None: # Faster encoder when installed
+            option = orjson.OPT_NON_STR_KEYS
+            if kwargs.get("sort_keys", self.sort_keys): # Same key order as the json module, cached bodies match too
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+        return super().dumps(obj, **kwargs)
+
+app.json = MongoJSONProvider(app) # Used by jsonify for every response
+
+# Builds the query for a place within a city
+def place_query(city_id, place_id):
+    return {"_id": ObjectId(place_id), "city_id": ObjectId(city_id)}
+
+# Builds the query for a review of a place, or all reviews of the place
+def review_query(city_id, place_id, review_id=None):
+    query = {"place_id": ObjectId(place_id), "city_id": ObjectId(city_id)}
+    if review_id is not None: # Single review
+        query["_id"] = ObjectId(review_id)
+    return query
+
+# Gives embedded reviews without an _id the _id of the stored review of the same place with the same review_id,
+# so sending the same reviews again replaces them instead of adding copies. One query for all the places
+def assign_review_ids(places):
+    unassigned = {} # (place _id, review_id) -> embedded review
+    for place in places:
+        for review in get_field(place, "ratings.recent_reviews") or []:
+            if isinstance(review, dict) and "_id" not in review and review.get("review_id") is not None:
+                unassigned[(place["_id"], review["review_id"])] = review
+    if not unassigned: # Nothing to match
+        return
+    for stored in reviews_collection.find({ # Uses the place_review_id index
+        "place_id": {"$in": list({place_id for place_id, _ in unassigned})},
+        "review_id": {"$in": list({review_id for _, review_id in unassigned})}
+    }, {"place_id": 1, "review_id": 1}):
+        review = unassigned.get((stored["place_id"], stored["review_id"]))
+        if review is not None:
+            review.setdefault("_id", stored["_id"])
+
+# Builds the writes that copy a place's embedded reviews into the reviews collection,
+# keeping only the latest few on the place, run them after the place itself is written
+def place_review_operations(place):
+    embedded = place.get("ratings", {}).get("recent_reviews", []) # Reviews stored on the place
+    operations = [] # Bulk write operations
+    for review in embedded: # For each embedded review
+        if isinstance(review.get("_id"), str) and ObjectId.is_valid(review["_id"]): # Read back from the API as a string
+            review["_id"] = ObjectId(review["_id"])
+        review.setdefault("_id", ObjectId()) # Reviews without an ID get a new one
+        operations.append(ReplaceOne( # Safe to re-run
+            {"_id": review["_id"]},
+            dict(review, place_id=place["_id"], city_id=place["city_id"]),
+            upsert=True
+        ))
+    if operations: # If place had reviews
+        ratings = place["ratings"]
+        if "rating_sum" not in ratings and len(embedded) == ratings.get("review_count"): # All reviews are here
+            ratings["rating_sum"] = sum(review.get("rating", 0) for review in embedded) # Exact running sum
+        embedded.sort(key=lambda review: str(review.get("date_posted", ""))) # Oldest first
+        place["ratings"]["recent_reviews"] = embedded[-RECENT_REVIEWS_LIMIT:] # Keep the latest
+    return operations
+
+# Copies a place's embedded reviews into the reviews collection, keeping only the latest few on the place
+def split_place_reviews(place):
+    operations = place_review_operations(place)
+    if operations: # If place had reviews
+        reviews_collection.bulk_write(operations, ordered=False)
+
+# Builds an atomic place update that adjusts the running rating totals, the average and the recent reviews in one write
+def rating_update(rating_change, count_change, recent_reviews):
+    rating_sum = {"$ifNull": [ # Older places without a running sum start from average x count
+        "$ratings.rating_sum",
+        {"$multiply": [{"$ifNull": ["$ratings.average_rating", 0]}, {"$ifNull": ["$ratings.review_count", 0]}]}
+    ]}
+    return [
+        {"$set": {
+            "ratings.rating_sum": {"$add": [rating_sum, rating_change]},
+            "ratings.review_count": {"$add": [{"$ifNull": ["$ratings.review_count", 0]}, count_change]},
+            "ratings.recent_reviews": recent_reviews
+        }},
+        {"$set": {
+            "ratings.average_rating": {"$cond": [ # Average from the new totals
+                {"$gt": ["$ratings.review_count", 0]},
+                {"$round": [{"$divide": ["$ratings.rating_sum", "$ratings.review_count"]}, 1]},
+                0
+            ]},
+            "ratings.score": {"$divide": [ # Bayesian score from the new totals, see bayesian_score
+                {"$add": [app.config['SCORE_PRIOR_MEAN'] * app.config['SCORE_PRIOR_WEIGHT'], "$ratings.rating_sum"]},
+                {"$add": [app.config['SCORE_PRIOR_WEIGHT'], "$ratings.review_count"]}
+            ]}
+        }}
+    ]
+
+# Average rating pulled towards the prior mean, so a few reviews can't outrank many good ones
+def bayesian_score(rating_sum, review_count):
+    prior_weight = app.config['SCORE_PRIOR_WEIGHT']
+    return (app.config['SCORE_PRIOR_MEAN'] * prior_weight + rating_sum) / (prior_weight + review_count)
+
+# Recounts the rating totals of places from their stored reviews, one aggregate for all of them
+def recount_ratings(place_oids):
+    totals = {row["_id"]: row for row in reviews_collection.aggregate([
+        {"$match": {"place_id": {"$in": place_oids}}},
+        {"$group": {"_id": "$place_id", "rating_sum": {"$sum": "$rating"}, "review_count": {"$sum": 1}}}
+    ])}
+    operations = []
+    for place_oid in place_oids:
+        row = totals.get(place_oid, {"rating_sum": 0, "review_count": 0}) # No reviews left
+        operations.append(UpdateOne({"_id": place_oid}, {"$set": {
+            "ratings.rating_sum": row["rating_sum"],
+            "ratings.review_count": row["review_count"],
+            "ratings.average_rating": round(row["rating_sum"] / row["review_count"], 1) if row["review_count"] else 0,
+            "ratings.score": bayesian_score(row["rating_sum"], row["review_count"])
+        }}))
+    if operations:
+        places_collection.bulk_write(operations, ordered=False)
+
+# Replaces all places of a city, keeping the _id and the rating totals of places whose place_id is unchanged
+def replace_city_places(city_oid, new_places):
+    existing = {place["place_id"]: place for place in places_collection.find( # Places already in the city
+        {"city_id": city_oid, "place_id": {"$in": [place["place_id"] for place in new_places]}},
+        {"place_id": 1, "ratings": 1}
+    )}
+    places = {} # place_id -> place, a later entry for the same place wins
+    recount = set() # Existing places sent with reviews, their totals are recounted once the reviews are written
+    for place in new_places: # For each new place
+        place = dict(place, city_id=city_oid) # Link place to the city
+        current = existing.get(place["place_id"])
+        place["_id"] = current["_id"] if current else ObjectId() # Keep the existing _id
+        sent = place.get("ratings") if isinstance(place.get("ratings"), dict) else None
+        if current and current.get("ratings"): # Totals belong to the server, its reviews are still stored
+            place["ratings"] = dict(current["ratings"])
+            if sent and sent.get("recent_reviews"): # Sent reviews replace the recent ones
+                place["ratings"]["recent_reviews"] = sent["recent_reviews"]
+                recount.add(place["_id"])
+        elif sent is None: # New place without ratings
+            place["ratings"] = {"average_rating": 0, "rating_sum": 0, "review_count": 0, "recent_reviews": []}
+        places[place["place_id"]] = place
+    assign_review_ids(list(places.values())) # Re-sent reviews keep their stored _id
+    operations, review_operations = [], [] # Place writes, then review writes
+    for place in places.values():
+        set_derived_fields(place) # Geo point and opening intervals
+        review_operations += place_review_operations(place) # Sent reviews go to the reviews collection
+        operations.append(ReplaceOne({"_id": place["_id"]}, place, upsert=True))
+    if operations: # If any places provided
+        places_collection.bulk_write(operations, ordered=False)
+    if review_operations: # Only once their places are written
+        reviews_collection.bulk_write(review_operations, ordered=False)
+    if recount: # Totals from the stored reviews, not from the request
+        recount_ratings(list(recount))
+    removed_ids = places_collection.distinct("_id", { # Places no longer in the list
+        "city_id": city_oid,
+        "place_id": {"$nin": [place["place_id"] for place in new_places]}
+    })
+    if removed_ids: # If any places removed
+        places_collection.delete_many({"_id": {"$in": removed_ids}})
+        reviews_collection.delete_many({"place_id": {"$in": removed_ids}}) # Remove their reviews
+
+# Boolean place fields that can be filtered on: group -> category -> options, the option is the request argument
+FLAG_FILTERS = {
+    'service_options': {
+        'dining': ['dine_in', 'takeaway', 'reservations', 'outdoor_seating', 'group_bookings'],
+        'meals': ['breakfast', 'lunch', 'dinner', 'brunch']
+    },
+    'menu_options': {
+        'food': ['vegetarian', 'kids_menu'],
+        'drinks': ['coffee', 'beer', 'wine', 'cocktails']
+    },
+    'amenities': {
+        'facilities': ['restrooms', 'wifi', 'parking'],
+        'accessibility': ['wheelchair_access', 'accessible_restroom', 'accessible_seating']
+    }
+}
+
+# Bit of each flag in a place's flags bitmask, new flags must go at the end
+FLAG_BITS = {
+    f"{group}.{category}.{option}": bit
+    for bit, (group, category, option) in enumerate(
+        (group, category, option)
+        for group, categories in FLAG_FILTERS.items()
+        for category, options in categories.items()
+        for option in options
+    )
+}
+
+# Reads the flag filters from the request arguments: bits that must be set, bits that must be clear, filters applied
+def flag_masks(args):
+    required, excluded = 0, 0
+    applied = {} # group -> category -> option -> value
+    for path, bit in FLAG_BITS.items(): # For each flag
+        group, category, option = path.split(".")
+        value = args.get(option, '').lower() # Get parameter value
+        if value in ['true', 'false']: # If valid boolean string
+            if value == 'true':
+                required |= 1 << bit
+            else:
+                excluded |= 1 << bit
+            applied.setdefault(group, {}).setdefault(category, {})[option] = value == 'true' # Track filter value
+    return required, excluded, applied
+
+# Builds the type, rating, flag and opening conditions of a place query from the request arguments
+def place_filter_conditions(args):
+    match_conditions = [] # Initialize conditions list
+    filters_applied = {} # Track all applied filters
+
+    # Adds place type filter
+    place_type = args.get('type') # Get type parameter
+    if place_type: # If type provided
+        match_conditions.append({"type_keys": type_key(place_type)}) # Match place type, any case
+        filters_applied['type'] = place_type # Track type filter
+
+    # Adds rating filter
+    min_rating = args.get('min_rating') # Get rating parameter
+    if min_rating: # If rating provided
+        try: # Try to convert rating
+            min_rating_float = float(min_rating) # Convert to float
+        except ValueError: # If rating conversion fails
+            raise ValueError("Invalid rating value")
+        match_conditions.append({"ratings.average_rating": {"$gte": min_rating_float}}) # Match minimum rating
+        filters_applied['min_rating'] = min_rating_float # Track rating filter
+
+    # Adds service, menu and amenity filters, all checked at once against the flags bitmask
+    required, excluded, flags_applied = flag_masks(args)
+    if required or excluded: # If any flag filters
+        condition = {}
+        if required: # Flags that must be true
+            condition["$bitsAllSet"] = required
+        if excluded: # Flags that must be false
+            condition["$bitsAllClear"] = excluded
+        match_conditions.append({"flags": condition})
+        filters_applied.update(flags_applied) # Track flag filters by group
+
+    # Adds opening hours filter
+    if args.get('open_now', '').lower() == 'true' or args.get('open_at'): # If open now or at a given time
+        moment = reference_time(args) # Raises ValueError for a bad open_at
+        minute = minute_of_week(moment)
+        match_conditions.append({"open_intervals": {"$elemMatch": { # Uses the open interval indexes
+            "start": {"$lte": minute},
+            "end": {"$gt": minute}
+        }}})
+        filters_applied['open_at'] = moment.isoformat(timespec="minutes") # Track opening time
+
+    return match_conditions, filters_applied
+
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'] # Keys of business_hours
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Gets the time the opening hours are checked against: open_at if given, otherwise now, in the places' time zone
+def reference_time(args):
+    timezone = ZoneInfo(app.config['PLACES_TIMEZONE'])
+    open_at = args.get('open_at')
+    if not open_at: # Now
+        return datetime.datetime.now(timezone)
+    try: # Time comes from the client
+        moment = datetime.datetime.fromisoformat(open_at)
+    except ValueError:
+        raise ValueError("Invalid open_at, use an ISO date and time")
+    if moment.tzinfo is None: # Local time of the places
+        return moment.replace(tzinfo=timezone)
+    return moment.astimezone(timezone)
+
+# Minutes since Monday 00:00 of a local time
+def minute_of_week(moment):
+    return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+# Converts "HH:MM" to minutes since midnight, None if empty or malformed
+def parse_minutes(text):
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(text or "").strip())
+    if not match: # Closed or unknown
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 24 or minutes > 59 or hours * 60 + minutes > MINUTES_PER_DAY: # Not a time of day
+        return None
+    return hours * 60 + minutes
+
+# Turns business_hours into sorted minute-of-week intervals, a close at or before the open runs past midnight
+def opening_intervals(hours):
+    intervals = []
+    if not isinstance(hours, dict): # No hours
+        return intervals
+    for index, day in enumerate(DAYS): # For each day of the week
+        day_hours = hours.get(day)
+        if not isinstance(day_hours, dict): # Closed that day
+            continue
+        opens, closes = parse_minutes(day_hours.get("open")), parse_minutes(day_hours.get("close"))
+        if opens is None or closes is None: # Closed or malformed
+            continue
+        start = index * MINUTES_PER_DAY + opens
+        end = index * MINUTES_PER_DAY + closes + (MINUTES_PER_DAY if closes <= opens else 0) # Past midnight
+        if end > MINUTES_PER_WEEK: # Sunday night into Monday morning
+            intervals.append({"start": start, "end": MINUTES_PER_WEEK})
+            intervals.append({"start": 0, "end": end - MINUTES_PER_WEEK})
+        else:
+            intervals.append({"start": start, "end": end})
+    return sorted(intervals, key=lambda interval: interval["start"])
+
+# Adds is_open and next_open to a place from its open intervals, which are then left out of the response
+def set_opening_status(place, moment):
+    intervals = place.pop("open_intervals", None) or []
+    minute = minute_of_week(moment)
+    place["is_open"] = any(interval["start"] <= minute < interval["end"] for interval in intervals)
+    if place["is_open"] or not intervals: # Open already, or never opens
+        place["next_open"] = None
+        return place
+    wait = min((interval["start"] - minute) % MINUTES_PER_WEEK for interval in intervals) # Minutes to the next opening
+    place["next_open"] = (moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=wait)).isoformat()
+    return place
+
+# Place fields worked out from other fields so they can be indexed
+DERIVED_PLACE_FIELDS = ["location.point", "open_intervals", "ratings.score", "flags", "type_keys"]
+DERIVED_FROM = ("location.coordinates", "business_hours", "service_options", "menu_options", "amenities", "info.type") # Updates to these paths change the derived fields
+
+# Place type as stored in type_keys, so type filters are exact index matches whatever the case
+def type_key(place_type):
+    return str(place_type).strip().lower()
+
+# Fills in the derived fields of a place document
+def set_derived_fields(place):
+    location = place.get("location")
+    if isinstance(location, dict): # Place has a location
+        coordinates = location.get("coordinates") or {}
+        latitude, longitude = coordinates.get("latitude"), coordinates.get("longitude")
+        if isinstance(latitude, (int, float)) and isinstance(longitude, (int, float)) \
+                and -90 <= latitude <= 90 and -180 <= longitude <= 180: # Valid position
+            location["point"] = {"type": "Point", "coordinates": [float(longitude), float(latitude)]} # GeoJSON is lng, lat
+        else: # No usable position, left out of the geo index
+            location.pop("point", None)
+    place["open_intervals"] = opening_intervals(place.get("business_hours")) # For open_now and open_at
+    ratings = place.get("ratings")
+    if isinstance(ratings, dict): # Score for sort_by=score and the top places
+        review_count = ratings.get("review_count") or 0
+        rating_sum = ratings.get("rating_sum")
+        if rating_sum is None: # Older places without a running sum
+            rating_sum = (ratings.get("average_rating") or 0) * review_count
+        ratings["score"] = bayesian_score(rating_sum, review_count)
+    place["flags"] = sum(1 << bit for path, bit in FLAG_BITS.items() if get_field(place, path) is True) # Flag filters
+    types = get_field(place, "info.type")
+    place["type_keys"] = sorted({type_key(place_type) for place_type in types}) if isinstance(types, list) else [] # Type filters
+    return place
+
+# Builds the update that stores a place's derived fields
+def derived_fields_update(place):
+    set_derived_fields(place)
+    values = {path: get_field(place, path) for path in DERIVED_PLACE_FIELDS}
+    update = {}
+    if any(value is not None for value in values.values()): # Fields to store
+        update["$set"] = {path: value for path, value in values.items() if value is not None}
+    if any(value is None for value in values.values()): # Fields to remove
+        update["$unset"] = {path: "" for path, value in values.items() if value is None}
+    return update
+
+# Recomputes the derived fields of a stored place after a partial update
+def refresh_derived_fields(query):
+    place = places_collection.find_one(query)
+    if place is not None: # Place still exists
+        places_collection.update_one({"_id": place["_id"]}, derived_fields_update(place))
+
+IMPORT_ERROR_LIMIT = 1000 # Most line errors listed in an import report, the rest are only counted
+
+# Records a failed import line in the report
+def import_error(report, line_number, message):
+    report["failed"] += 1
+    if len(report["errors"]) < IMPORT_ERROR_LIMIT: # Keep the report small
+        report["errors"].append({"line": line_number, "error": message})
+
+# Writes one batch of imported places with an unordered bulk write, replacing places with the same place_id,
+# then the reviews of the places that were written. Every line has a place_id so a re-import finds its places
+def write_import_batch(city_oid, batch, report):
+    place_ids = [data["place_id"] for _, data in batch]
+    existing = {place["place_id"]: place for place in places_collection.find( # Places already in the city
+        {"city_id": city_oid, "place_id": {"$in": place_ids}}, {"place_id": 1, "ratings": 1}
+    )}
+    places, line_numbers = [], [] # Places to write and the line each came from
+    positions = {} # place_id -> position in places, a later line for the same place wins
+    for line_number, data in batch:
+        place = dict(data, city_id=city_oid) # Link place to the city
+        place.pop("_id", None)
+        current = existing.get(place["place_id"])
+        if place["place_id"] in positions: # Same place earlier in this batch
+            place["_id"] = places[positions[place["place_id"]]]["_id"]
+        else:
+            place["_id"] = current["_id"] if current else ObjectId() # Keep the existing _id
+        if "ratings" not in place: # Keep the ratings of an existing place
+            place["ratings"] = current.get("ratings") if current and current.get("ratings") else {
+                "average_rating": 0, "rating_sum": 0, "review_count": 0, "recent_reviews": []
+            }
+        try:
+            set_derived_fields(place)
+        except Exception as err: # Bad fields
+            import_error(report, line_number, str(err))
+            continue
+        if place["place_id"] in positions: # Replace the earlier place
+            places[positions[place["place_id"]]] = place
+            line_numbers[positions[place["place_id"]]] = line_number
+            continue
+        positions[place["place_id"]] = len(places)
+        places.append(place)
+        line_numbers.append(line_number)
+    assign_review_ids(places) # Re-imported reviews keep their stored _id, safe to run every night
+    operations, review_operations, operation_lines = [], [], [] # Place writes, their review writes and lines
+    for place, line_number in zip(places, line_numbers):
+        try: # Reviews in the line go to the reviews collection once the place is written
+            reviews = place_review_operations(place)
+        except Exception as err: # Bad reviews
+            import_error(report, line_number, str(err))
+            continue
+        operations.append(ReplaceOne({"_id": place["_id"]}, place, upsert=True))
+        review_operations.append(reviews)
+        operation_lines.append(line_number)
+    if not operations: # Whole batch failed
+        return
+    failed = set() # Indexes of places that were not written
+    try:
+        result = places_collection.bulk_write(operations, ordered=False) # Keeps going past failed places
+        report["inserted"] += result.upserted_count
+        report["updated"] += result.matched_count
+    except BulkWriteError as err: # Some places failed
+        report["inserted"] += err.details.get("nUpserted", 0)
+        report["updated"] += err.details.get("nMatched", 0)
+        for error in err.details.get("writeErrors", []): # Back to the line it came from
+            failed.add(error["index"])
+            import_error(report, operation_lines[error["index"]], error.get("errmsg"))
+    reviews = [review for index, place_reviews in enumerate(review_operations) if index not in failed
+               for review in place_reviews] # Only for places that were written
+    if reviews:
+        reviews_collection.bulk_write(reviews, ordered=False)
+
+# Reads NDJSON lines into batches of (line number, data), recording lines that are not JSON or fail validation
+def ndjson_batches(lines, batch_size, report, validate):
+    batch = []
+    for line_number, line in enumerate(lines, 1): # Streams the input
+        if not line.strip(): # Skip blank lines
+            continue
+        report["lines"] += 1
+        try:
+            data = json.loads(line)
+        except ValueError as err: # Not JSON
+            import_error(report, line_number, f"Invalid JSON: {err}")
+            continue
+        try:
+            valid, message = validate(data)
+        except Exception as err: # Validator tripped on a bad field, report the line rather than abort the import
+            valid, message = False, f"Invalid data: {err}"
+        if not valid: # Fails validation
+            import_error(report, line_number, message)
+            continue
+        batch.append((line_number, data))
+        if len(batch) >= batch_size: # Batch full
+            yield batch
+            batch = []
+    if batch: # Last batch
+        yield batch
+
+# Imports places into a city from NDJSON lines, one place per line, holding only one batch in memory
+def import_places(city_oid, lines, batch_size):
+    report = {"lines": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    started = time.perf_counter()
+    for batch in ndjson_batches(lines, batch_size, report, validate_imported_place):
+        write_import_batch(city_oid, batch, report)
+    report["errors_truncated"] = report["failed"] > len(report["errors"]) # More errors than listed
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    response_cache.invalidate(str(city_oid)) # Cached reads of the city are stale
+    flag_index.invalidate(str(city_oid))
+    name_index.reset() # New names for autocomplete
+    return report
+
+# Writes one batch of reviews: the reviews in one unordered bulk write grouped by place,
+# then one rating update per place for everything the batch added to it.
+# Reviews are upserted on (place_id, review_id) so a re-run only adds and counts the reviews that aren't stored yet
+def write_review_batch(batch, report, cities):
+    groups = {} # place _id -> [(line number, review)]
+    seen = set() # (place _id, review_id) already in this batch
+    for line_number, data in batch:
+        key = (ObjectId(data["place_id"]), data["review_id"])
+        if key in seen: # Same review twice in the batch
+            import_error(report, line_number, "Duplicate review_id for this place")
+            continue
+        seen.add(key)
+        review = { # Same fields as add_new_review
+            "_id": ObjectId(),
+            "review_id": data["review_id"],
+            "rating": float(data["rating"]),
+            "author_name": data["author_name"],
+            "content": data["content"],
+            "date_posted": data.get("date_posted") or datetime.datetime.now(datetime.UTC).isoformat(),
+            "language": data.get("language", "en")
         }
-    else:
-        return document  # Return the original value if not a dict or list
+        groups.setdefault(key[0], []).append((line_number, review))
+    places = {place["_id"]: place for place in places_collection.find( # Places of the batch in one query
+        {"_id": {"$in": list(groups)}}, {"city_id": 1}
+    )}
+
+    operations, entries = [], [] # Review upserts and the (place _id, line number, review) of each
+    for place_oid, reviews in groups.items():
+        place = places.get(place_oid)
+        if place is None: # Unknown place
+            for line_number, _ in reviews:
+                import_error(report, line_number, "Place not found")
+            continue
+        for line_number, review in reviews: # Kept together by place
+            operations.append(UpdateOne( # Uses the place_review_id index, a stored review is left as it is
+                {"place_id": place_oid, "review_id": review["review_id"]},
+                {"$setOnInsert": dict(review, place_id=place_oid, city_id=place["city_id"])},
+                upsert=True
+            ))
+            entries.append((place_oid, line_number, review))
+    if not operations: # Whole batch failed
+        return
+    failed = set() # Indexes of reviews that were not written
+    try:
+        result = reviews_collection.bulk_write(operations, ordered=False) # Keeps going past failed reviews
+        upserted = set(result.upserted_ids) # Indexes of reviews that weren't stored before
+    except BulkWriteError as err: # Some reviews failed
+        upserted = {upsert["index"] for upsert in err.details.get("upserted", [])}
+        for error in err.details.get("writeErrors", []): # Back to the line it came from
+            failed.add(error["index"])
+            import_error(report, entries[error["index"]][1], error.get("errmsg"))
+    report["existing"] += len(entries) - len(upserted) - len(failed) # Stored by an earlier run
+
+    written = {} # place _id -> [(line number, review)] inserted by this batch
+    for index, (place_oid, line_number, review) in enumerate(entries):
+        if index in upserted: # Only new reviews change the totals
+            written.setdefault(place_oid, []).append((line_number, review))
+    if not written: # Nothing new
+        return
+    place_oids, updates = list(written), []
+    for place_oid in place_oids: # One atomic rating update per place, merged with its current reviews
+        reviews = [review for _, review in written[place_oid]]
+        updates.append(UpdateOne({"_id": place_oid}, rating_update(
+            sum(review["rating"] for review in reviews), len(reviews), {"$slice": [
+                {"$sortArray": { # Oldest first, imported history can be older than the reviews already there
+                    "input": {"$concatArrays": [RECENT_REVIEWS, {"$literal": reviews}]},
+                    "sortBy": {"date_posted": 1}
+                }},
+                -RECENT_REVIEWS_LIMIT
+            ]}
+        )))
+    try:
+        places_collection.bulk_write(updates, ordered=False)
+        not_updated = {}
+    except BulkWriteError as err: # Some places kept their totals
+        not_updated = {place_oids[error["index"]]: error.get("errmsg") for error in err.details.get("writeErrors", [])}
+    except Exception: # Totals unchanged, take the new reviews back out so a re-run adds them again
+        reviews_collection.delete_many({"_id": {"$in": [review["_id"] for reviews in written.values() for _, review in reviews]}})
+        raise
+    if not_updated: # Same as add_new_review, a review the totals don't count isn't kept
+        reviews_collection.delete_many({"_id": {"$in": [review["_id"] for place_oid in not_updated for _, review in written[place_oid]]}})
+    for place_oid, reviews in written.items():
+        if place_oid in not_updated:
+            for line_number, _ in reviews:
+                import_error(report, line_number, f"Rating update failed: {not_updated[place_oid]}")
+            continue
+        report["inserted"] += len(reviews)
+        report["places_updated"] += 1
+        cities.add(places[place_oid]["city_id"])
+
+# Imports reviews for many places from NDJSON lines, one review per line with the place's _id as place_id and a review_id
+def import_reviews(lines, batch_size):
+    report = {"lines": 0, "inserted": 0, "existing": 0, "places_updated": 0, "failed": 0, "errors": []}
+    started = time.perf_counter()
+    cities = set() # Cities whose cached reads are stale
+    for batch in ndjson_batches(lines, batch_size, report, validate_imported_review):
+        write_review_batch(batch, report, cities)
+    seconds = time.perf_counter() - started
+    report["errors_truncated"] = report["failed"] > len(report["errors"]) # More errors than listed
+    report["seconds"] = round(seconds, 3)
+    report["reviews_per_second"] = round(report["inserted"] / seconds, 1) if seconds else None # Throughput
+    for city_oid in cities:
+        response_cache.invalidate(str(city_oid))
+    return report
 
 # Calculates the pagination
 def calculate_pagination(total_items, page_size, page_num): 
@@ -72,6 +826,63 @@ def calculate_pagination(total_items, page_size, page_num):
         "total_items": total_items
     }
 
+# Gets a value from a document by dotted path, e.g. "info.name"
+def get_field(document, path):
+    for key in path.split("."): # Walk down each level
+        if not isinstance(document, dict): # Path ends early
+            return None
+        document = document.get(key)
+    return document
+
+# Encodes the sort value and _id of the last item on a page into an opaque cursor
+def encode_cursor(sort_value, last_id):
+    raw = json.dumps([sort_value, str(last_id)]) # Sort key plus _id tiebreaker
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+# Decodes a cursor back into its sort value and _id
+def decode_cursor(cursor):
+    try: # Cursor comes from the client
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return sort_value, ObjectId(last_id)
+    except Exception: # Any malformed cursor
+        raise ValueError("Invalid cursor")
+
+# Builds the query condition for the items after a cursor, in sort order
+def cursor_condition(cursor, sort_field, sort_direction):
+    sort_value, last_id = decode_cursor(cursor)
+    operator = "$gt" if sort_direction == ASCENDING else "$lt" # Direction of the next page
+    return {"$or": [
+        {sort_field: {operator: sort_value}}, # Past the last sort value
+        {sort_field: sort_value, "_id": {operator: last_id}} # Same sort value, past the last _id
+    ]}
+
+# Gets a page of results, whether more follow it and, if wanted, the total count in one round trip.
+# One extra item is read to tell if there is a next page. Pages after a cursor start at the cursor in the
+# index and have no total, counting would read every match on every page
+def find_page(collection, query, sort, page_start, page_size, after=None, projection=None, include_total=True):
+    if after or not include_total: # Page only, straight from the index
+        page_query = {"$and": [query, after]} if after else query
+        results = list(collection.find(page_query, projection).sort(sort).skip(page_start).limit(page_size + 1))
+        return results[:page_size], None, len(results) > page_size
+
+    pipeline = [{"$match": query}, {"$sort": dict(sort)}] # Indexed match and sort
+    if projection: # Only the returned fields
+        pipeline.append({"$project": projection})
+    page_stages = [{"$skip": page_start}, {"$limit": page_size + 1}]
+    pipeline.append({"$facet": { # Page and total from the same pass
+        "items": page_stages,
+        "total": [{"$count": "count"}]
+    }})
+    result = next(collection.aggregate(pipeline))
+    total = result["total"][0]["count"] if result["total"] else 0 # No matches gives no count row
+    return result["items"][:page_size], total, len(result["items"]) > page_size
+
+# Gets the cursor for the page after the given one, or None on the last page
+def next_page_cursor(page, sort_field, has_more):
+    if not has_more or not page: # Nothing after this page
+        return None
+    return encode_cursor(get_field(page[-1], sort_field), page[-1]["_id"])
+
 ''''''
 # Validation functions
 ''''''
@@ -108,8 +919,12 @@ def validate_place_data(data):
     if 'status' in info and info['status'] not in ['open', 'closed', 'temporary_closed']:
         return False, "Invalid status value"
     # Validates coordinates if present (critical for mapping)
+    if 'location' in data and not isinstance(data['location'], dict):
+        return False, "Invalid location section"
     if 'location' in data and 'coordinates' in data['location']:
         coords = data['location']['coordinates']
+        if not isinstance(coords, dict):
+            return False, "Invalid coordinate format"
         try:
             lat = float(coords.get('latitude', 0))
             lng = float(coords.get('longitude', 0))
@@ -120,6 +935,34 @@ def validate_place_data(data):
 
     return True, None
 
+# For imported places, same rules as validate_place_data plus the place_id re-imports are matched on
+def validate_imported_place(data):
+    valid, message = validate_place_data(data)
+    if not valid:
+        return valid, message
+    if not isinstance(data.get('place_id'), str) or not data['place_id'].strip():
+        return False, "Missing or invalid place_id"
+    return True, None
+
+# For imported reviews, same rules as add_new_review plus the place they belong to
+def validate_imported_review(data):
+    if not isinstance(data, dict):
+        return False, "Invalid data format"
+    if not ObjectId.is_valid(str(data.get('place_id', ''))):
+        return False, "Missing or invalid place_id"
+    if not isinstance(data.get('review_id'), str) or not data['review_id'].strip(): # Matched on by re-runs
+        return False, "Missing or invalid review_id"
+    for field in ['rating', 'author_name', 'content']: # Required fields
+        if field not in data:
+            return False, f"Missing required field: {field}"
+    try:
+        rating = float(data['rating'])
+    except (ValueError, TypeError):
+        return False, "Rating must be a number"
+    if not 1 <= rating <= 5:
+        return False, "Rating must be between 1 and 5"
+    return True, None
+
 # For pagination
 def validate_pagination_params(page_num, page_size):
     try:
@@ -204,6 +1047,467 @@ def validate_review_data(data): # Validates review data from form or JSON
     except Exception as e: # Handle any validation errors
         return None, f"Validation error: {str(e)}" # Return error message
 
+''''''
+# Caches
+''''''
+# Bounded LRU cache with a TTL for GET responses, grouped by city so writes can drop them
+class ResponseCache:
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries # Most entries kept
+        self.ttl_seconds = ttl_seconds # Lifetime of an entry
+        self.entries = OrderedDict() # key -> (expires_at, city_id, body, status), least recent first
+        self.city_keys = {} # city_id -> keys cached for that city, None is the city list
+        self.lock = threading.Lock() # Requests run on several threads
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def get(self, key): # Returns (body, status) or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: # Not cached
+                self.stats["misses"] += 1
+                return None
+            if entry[0] < time.monotonic(): # Too old
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key) # Most recently used
+            self.stats["hits"] += 1
+            return entry[2], entry[3]
+
+    def set(self, key, city_id, body, status):
+        with self.lock:
+            if key in self.entries: # Replace an old entry
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, city_id, body, status)
+            self.city_keys.setdefault(city_id, set()).add(key)
+            while len(self.entries) > self.max_entries: # Drop least recently used
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, city_id): # Drops every entry cached for a city
+        with self.lock:
+            for key in self.city_keys.pop(city_id, set()):
+                self.entries.pop(key, None)
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.city_keys.clear()
+
+    def info(self): # Counters and size
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), max_entries=self.max_entries, ttl_seconds=self.ttl_seconds)
+
+    def _remove(self, key): # Caller holds the lock
+        entry = self.entries.pop(key)
+        keys = self.city_keys.get(entry[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys: # No entries left for this city
+                del self.city_keys[entry[1]]
+
+response_cache = ResponseCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL_SECONDS'])
+
+# Revoked tokens held in memory so valid tokens never touch the blacklist collection
+class RevocationCache:
+    def __init__(self, sync_seconds):
+        self.sync_seconds = sync_seconds # Gap between reads of new blacklist entries
+        self.revoked = {} # token hash -> expiry timestamp
+        self.next_sync = 0 # When the blacklist is read again
+        self.lock = threading.Lock()
+        self.stats = {"checks": 0, "possible_hits": 0, "syncs": 0}
+
+    @staticmethod
+    def token_key(token): # Fixed size key instead of the whole token
+        return hashlib.sha256(token.encode()).digest()
+
+    def add(self, token, expires_at): # expires_at is a unix timestamp
+        with self.lock:
+            self.revoked[self.token_key(token)] = expires_at
+
+    def sync(self): # Reads every unexpired blacklist entry, tokens revoked by other processes included.
+        # ObjectIds are made by each client and aren't in insert order, so reading past the newest one seen can skip entries
+        with self.lock:
+            if time.monotonic() < self.next_sync: # Synced recently
+                return
+            self.next_sync = time.monotonic() + self.sync_seconds # Only one thread reads the blacklist
+        now = time.time()
+        entries = []
+        for entry in blacklist.find({"$or": [ # Small, tokens live 30 minutes and the TTL index drops the rest
+            {"exp": {"$gt": datetime.datetime.fromtimestamp(now, datetime.UTC)}},
+            {"exp": {"$exists": False}} # Entries from before exp was stored
+        ]}, {"token": 1, "exp": 1}):
+            expires_at = entry.get("exp")
+            if isinstance(expires_at, datetime.datetime): # Stored as a UTC date
+                expires_at = expires_at.replace(tzinfo=datetime.UTC).timestamp()
+            else: # Entries from before exp was stored, read it from the token
+                try:
+                    expires_at = jwt.decode(entry["token"], options={"verify_signature": False})["exp"]
+                except (jwt.InvalidTokenError, KeyError):
+                    expires_at = float("inf") # Keep it, the database confirms anyway
+            entries.append((entry["token"], expires_at))
+        with self.lock:
+            for token, expires_at in entries:
+                if expires_at > now: # Expired tokens are rejected by jwt.decode
+                    self.revoked[self.token_key(token)] = expires_at
+            for key in [key for key, expires_at in self.revoked.items() if expires_at <= now]:
+                del self.revoked[key] # Drop tokens that have expired
+            self.stats["syncs"] += 1
+
+    def might_be_revoked(self, token): # False means the token is not blacklisted
+        self.sync()
+        with self.lock:
+            self.stats["checks"] += 1
+            if self.token_key(token) in self.revoked:
+                self.stats["possible_hits"] += 1
+                return True
+            return False
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.revoked), sync_seconds=self.sync_seconds)
+
+revocation_cache = RevocationCache(app.config['REVOCATION_SYNC_SECONDS'])
+
+# Bounded LRU of verified tokens and their claims, an entry is only used until the token's exp
+class TokenCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries # Most tokens kept
+        self.entries = OrderedDict() # token hash -> claims, least recent first
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def decode(self, token): # Returns the claims, raises jwt.InvalidTokenError like jwt.decode
+        key = hashlib.sha256(token.encode()).digest()
+        with self.lock:
+            claims = self.entries.get(key)
+            if claims is not None and claims["exp"] > time.time(): # Verified before and not expired
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return claims
+            self.entries.pop(key, None) # Expired, decode again so the error is raised
+            self.stats["misses"] += 1
+        claims = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"]) # Checks the signature and exp
+        if "exp" in claims: # Tokens without exp are never cached
+            with self.lock:
+                self.entries[key] = claims
+                while len(self.entries) > self.max_entries: # Drop least recently used
+                    self.entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+        return claims
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries), max_entries=self.max_entries)
+
+token_cache = TokenCache(app.config['TOKEN_CACHE_MAX_ENTRIES'])
+
+# City and place names held in memory for autocomplete: a sorted list of word starts for prefixes,
+# and trigrams for names that are misspelt. Rebuilt in a background thread, lookups keep using the current index
+class NameIndex:
+    def __init__(self, refresh_seconds, first_build_wait=5):
+        self.refresh_seconds = refresh_seconds # Gap between full rebuilds
+        self.first_build_wait = first_build_wait # Longest the first lookups wait for the first build
+        self.entries = {} # (kind, _id) -> suggestion
+        self.words = [] # Sorted (name from a word onwards, key) pairs
+        self.trigrams = {} # trigram -> keys of names containing it
+        self.built_at = None # When last rebuilt, None means rebuild on next lookup
+        self.pending = None # Changes made while a build is loading, replayed on the new index
+        self.resets = 0 # Bumped by reset, a build that was loading during a reset is redone
+        self.built = threading.Event() # Set once the first build has finished
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def normalize(text): # Lower case with single spaces
+        return " ".join(str(text).lower().split())
+
+    @staticmethod
+    def trigrams_of(text, whole=True): # Letter triples, padded so word starts count
+        padded = "  " + text + (" " if whole else "")
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @classmethod
+    def index_name(cls, entries, trigrams, key, suggestion): # Adds a name and its trigrams, returns its word starts
+        name = cls.normalize(suggestion["name"])
+        if not name: # Nothing to match
+            return []
+        entries[key] = suggestion
+        for gram in cls.trigrams_of(name):
+            trigrams.setdefault(gram, set()).add(key)
+        words = name.split(" ")
+        return [(" ".join(words[i:]), key) for i in range(len(words))] # Match from the start of any word
+
+    def add_city(self, city_id, name):
+        self._change(("city", city_id), {"type": "city", "_id": city_id, "name": name})
+
+    def add_place(self, place_id, city_id, name):
+        self._change(("place", place_id), {"type": "place", "_id": place_id, "city_id": city_id, "name": name})
+
+    def remove(self, kind, entry_id):
+        self._change((kind, entry_id), None)
+
+    def reset(self): # Rebuild from the database, starting on next lookup
+        with self.lock:
+            self.built_at = None
+            self.resets += 1
+
+    def refresh(self): # Starts a rebuild in a background thread unless one is already loading
+        with self.lock:
+            if self.pending is not None: # Already loading
+                return
+            self.pending = []
+        threading.Thread(target=self.build, daemon=True).start()
+
+    def build(self): # Loads every city and place name outside the lock, then swaps the new index in
+        try:
+            with self.lock:
+                resets = self.resets
+            entries, words, trigrams = {}, [], {}
+            for city in businesses.find({}, {"city_name": 1}):
+                words += self.index_name(entries, trigrams, ("city", city["_id"]), {
+                    "type": "city", "_id": city["_id"], "name": city.get("city_name") or ""
+                })
+            for place in places_collection.find({}, {"city_id": 1, "info.name": 1}):
+                words += self.index_name(entries, trigrams, ("place", place["_id"]), {
+                    "type": "place", "_id": place["_id"], "city_id": place.get("city_id"),
+                    "name": get_field(place, "info.name") or ""
+                })
+            words.sort() # One sort instead of an insert per name
+            with self.lock:
+                self.entries, self.words, self.trigrams = entries, words, trigrams
+                for key, suggestion in self.pending: # Changes the load may have missed
+                    self._apply(key, suggestion)
+                self.built_at = time.monotonic() if self.resets == resets else None # Reset while loading, load again
+        except Exception as err: # Keep the old index, try again on a later lookup
+            print(f"Could not rebuild the name index: {err}")
+        finally:
+            with self.lock:
+                self.pending = None
+            self.built.set()
+
+    def lookup(self, prefix, limit): # Prefix matches first, then close misspellings
+        with self.lock:
+            stale = self.built_at is None or time.monotonic() - self.built_at > self.refresh_seconds
+        if stale: # Rebuilt in the background
+            self.refresh()
+        self.built.wait(self.first_build_wait) # Only waits before the first build is done
+        with self.lock:
+            prefix = self.normalize(prefix)
+            found = [] # (key, how it matched)
+            seen = set()
+            position = bisect.bisect_left(self.words, (prefix,)) # First word start at or after the prefix
+            while position < len(self.words) and len(found) < limit:
+                text, key = self.words[position]
+                if not text.startswith(prefix): # Past the prefix
+                    break
+                if key not in seen: # Names match once
+                    seen.add(key)
+                    found.append((key, "prefix"))
+                position += 1
+            if len(found) < limit and len(prefix) >= 3: # Not enough, try trigrams for typos
+                grams = self.trigrams_of(prefix, whole=False)
+                shared = Counter(key for gram in grams for key in self.trigrams.get(gram, ()))
+                fuzzy = sorted(
+                    (key for key, count in shared.items() if key not in seen and count / len(grams) >= 0.5),
+                    key=lambda key: (-shared[key], self.normalize(self.entries[key]["name"]))
+                )
+                found += [(key, "fuzzy") for key in fuzzy[:limit - len(found)]]
+            return [dict(self.entries[key], match=match) for key, match in found]
+
+    def _change(self, key, suggestion): # Adds, renames or removes (suggestion None) one name
+        with self.lock:
+            if self.pending is not None: # A build is loading, replay this on its index too
+                self.pending.append((key, suggestion))
+            self._apply(key, suggestion)
+
+    def _apply(self, key, suggestion): # Caller holds the lock
+        self._remove(key) # Names can change
+        if suggestion is not None:
+            for word in self.index_name(self.entries, self.trigrams, key, suggestion):
+                bisect.insort(self.words, word)
+
+    def _remove(self, key): # Caller holds the lock
+        suggestion = self.entries.pop(key, None)
+        if suggestion is None: # Not indexed
+            return
+        name = self.normalize(suggestion["name"])
+        words = name.split(" ")
+        for i in range(len(words)):
+            entry = (" ".join(words[i:]), key)
+            position = bisect.bisect_left(self.words, entry)
+            if position < len(self.words) and self.words[position] == entry:
+                del self.words[position]
+        for gram in self.trigrams_of(name):
+            keys = self.trigrams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys: # No names left with this trigram
+                    del self.trigrams[gram]
+
+name_index = NameIndex(app.config['AUTOCOMPLETE_REFRESH_SECONDS'])
+
+# Per-city bitmaps of the place flags: bit n of a flag's bitmap is the n-th place of the city,
+# so any mix of flag filters is an AND of bitmaps and its count a popcount
+class FlagIndex:
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds # Rebuilt after this to pick up other processes' writes
+        self.cities = {} # city_id -> (expires_at, place count, bitmap per flag bit)
+        self.lock = threading.Lock()
+
+    def bitmaps(self, city_id): # Returns (place count, bitmaps), building them from the flags of the city's places
+        with self.lock:
+            entry = self.cities.get(city_id)
+        if entry is not None and entry[0] > time.monotonic(): # Built and fresh
+            return entry[1], entry[2]
+        bitmaps = [0] * len(FLAG_BITS)
+        count = 0
+        for place in places_collection.find({"city_id": ObjectId(city_id)}, {"flags": 1}): # Only the bitmask
+            flags = place.get("flags") or 0
+            for bit in range(len(FLAG_BITS)):
+                if flags >> bit & 1: # Place has this flag
+                    bitmaps[bit] |= 1 << count
+            count += 1
+        with self.lock:
+            self.cities[city_id] = (time.monotonic() + self.ttl_seconds, count, bitmaps)
+        return count, bitmaps
+
+    def select(self, city_id, required, excluded): # Bitmap of the city's places matching the flag masks
+        count, bitmaps = self.bitmaps(city_id)
+        selected = (1 << count) - 1 # Every place
+        for bit in range(len(FLAG_BITS)):
+            if required >> bit & 1: # Must have the flag
+                selected &= bitmaps[bit]
+            elif excluded >> bit & 1: # Must not have the flag
+                selected &= ~bitmaps[bit]
+        return selected, bitmaps
+
+    def invalidate(self, city_id): # Rebuilt on next use
+        with self.lock:
+            self.cities.pop(city_id, None)
+
+flag_index = FlagIndex(app.config['CACHE_TTL_SECONDS'])
+
+''''''
+# Password hashing
+''''''
+# Run in the worker processes
+def hash_password(password, rounds): # Returns a new bcrypt hash
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds))
+
+def check_password(password, hashed): # True if the password matches the hash
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+class PasswordPoolFull(Exception): # Too many hashes waiting
+    pass
+
+class PasswordPoolUnavailable(PasswordPoolFull): # A worker died or the hash took too long, also answered with a 503
+    pass
+
+# Bounded process pool for bcrypt so logins don't hold up the request threads
+class PasswordHasher:
+    def __init__(self, workers, max_pending):
+        self.workers = workers # Processes in the pool
+        self.max_pending = max_pending # Most hashes queued or running
+        self.slots = threading.BoundedSemaphore(max_pending) # One slot per queued or running hash
+        self.executor = None # Started on first use
+        self.lock = threading.Lock()
+        self.stats = {"submitted": 0, "rejected": 0, "rehashed": 0, "timed_out": 0, "restarted": 0}
+
+    def run(self, func, *args): # Runs func in the pool and waits for it, raises PasswordPoolFull
+        if not self.slots.acquire(blocking=False): # Queue is full
+            with self.lock:
+                self.stats["rejected"] += 1
+            raise PasswordPoolFull()
+        try:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                executor = self.executor
+                self.stats["submitted"] += 1
+            future = executor.submit(func, *args)
+        except BrokenProcessPool: # A worker died before this was queued
+            self.slots.release()
+            self.restart(executor)
+            raise PasswordPoolUnavailable()
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release()) # Slot held until the hash finishes
+        try:
+            return future.result(timeout=app.config['BCRYPT_TIMEOUT_SECONDS'])
+        except FutureTimeoutError: # Still queued or running, its slot is freed when it finishes
+            with self.lock:
+                self.stats["timed_out"] += 1
+            raise PasswordPoolUnavailable()
+        except BrokenProcessPool: # A worker died, e.g. killed for memory, the pool can't run anything else
+            self.restart(executor)
+            raise PasswordPoolUnavailable()
+
+    def restart(self, broken): # Replaces a broken pool, the next hash starts a new one
+        with self.lock:
+            if self.executor is not broken: # Already replaced by another request
+                return
+            self.executor = None
+            self.stats["restarted"] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        return self.run(hash_password, password, app.config['BCRYPT_ROUNDS'])
+
+    def check(self, password, hashed):
+        return self.run(check_password, password, hashed)
+
+    @staticmethod
+    def needs_rehash(hashed): # True if the hash was made with another cost
+        return int(hashed[4:6]) != app.config['BCRYPT_ROUNDS'] # Hash starts with $2b$<cost>$
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, workers=self.workers, max_pending=self.max_pending)
+
+password_hasher = PasswordHasher(app.config['BCRYPT_WORKERS'], app.config['BCRYPT_MAX_PENDING'])
+
+''''''
+# Rate limiting
+''''''
+# Token buckets keyed by a string, bounded LRU so a flood of new keys can't grow memory
+class TokenBucketLimiter:
+    def __init__(self, capacity, refill_rate, max_keys):
+        self.capacity = capacity # Most tokens a bucket holds
+        self.refill_rate = refill_rate # Tokens added per second
+        self.max_keys = max_keys # Most buckets kept
+        self.buckets = OrderedDict() # key -> (tokens, last refill), least recent first
+        self.lock = threading.Lock()
+        self.stats = {"allowed": 0, "rejected": 0, "evictions": 0}
+
+    def take(self, key): # Returns 0 if allowed, otherwise seconds until a token is free
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.refill_rate) # Refill since last use
+            if tokens >= 1: # Allowed
+                tokens -= 1
+                wait = 0
+                self.stats["allowed"] += 1
+            else: # Over the limit
+                wait = (1 - tokens) / self.refill_rate
+                self.stats["rejected"] += 1
+            self.buckets[key] = (tokens, now) # Most recently used
+            while len(self.buckets) > self.max_keys: # Drop least recently used
+                self.buckets.popitem(last=False)
+                self.stats["evictions"] += 1
+            return wait
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.buckets), max_keys=self.max_keys,
+                        capacity=self.capacity, refill_rate=self.refill_rate)
+
+username_limiter = TokenBucketLimiter(*app.config['LOGIN_USERNAME_BUCKET'], app.config['RATE_LIMIT_MAX_KEYS'])
+ip_limiter = TokenBucketLimiter(*app.config['LOGIN_IP_BUCKET'], app.config['RATE_LIMIT_MAX_KEYS'])
+
 ''''''
 # Decorators
 ''''''
@@ -219,19 +1523,17 @@ def jwt_required(func): # Decorator for JWT validation
             return make_response(jsonify({"error": "Token is missing"}), 401)
             
         try: # Try to decode token
-            data = jwt.decode( # Decode JWT token
-                token, # Token to decode
-                app.config['SECRET_KEY'], # Secret key
-                algorithms=["HS256"] # Algorithm used
-            )
+            data = token_cache.decode(token) # Decode JWT token, verified tokens are cached
             
-            # Check if token is blacklisted
-            bl_token = blacklist.find_one({"token": token}) # Check blacklist
-            if bl_token is not None: # If token found in blacklist
-                return make_response(jsonify({"error": "Token has been cancelled"}), 401)
+            # Check if token is blacklisted, the database is only asked on a possible hit
+            if revocation_cache.might_be_revoked(token):
+                bl_token = blacklist.find_one({"token": token}) # Check blacklist
+                if bl_token is not None: # If token found in blacklist
+                    return make_response(jsonify({"error": "Token has been cancelled"}), 401)
                 
         except: # If token invalid
             return make_response(jsonify({"error": "Token is invalid"}), 401)
+        g.jwt_claims = data # Decoded once for the rest of the request
         return func(*args, **kwargs) # Call original function
 
     return jwt_required_wrapper
@@ -239,22 +1541,70 @@ def jwt_required(func): # Decorator for JWT validation
 def admin_required(func): # Decorator for admin validation
     @wraps(func)
     def admin_required_wrapper(*args, **kwargs): # Wrapper function
-        token = request.headers['x-access-token'] # Get token
-        data = jwt.decode( # Decode token
-            token, 
-            app.config['SECRET_KEY'],
-            algorithms=["HS256"]
-        )
-        if data["admin"]: # If user is admin
+        data = g.get("jwt_claims") # Claims decoded by jwt_required
+        if data is None: # Used without jwt_required
+            try:
+                data = token_cache.decode(request.headers['x-access-token']) # Decode token
+            except (KeyError, jwt.InvalidTokenError): # Missing or invalid token
+                return make_response(jsonify({"error": "Token is invalid"}), 401)
+            g.jwt_claims = data
+        if data.get("admin"): # If user is admin
             return func(*args, **kwargs) # Call original function
         else: # If user not admin
             return make_response(jsonify({"error": "Admin access required"}), 401)
     return admin_required_wrapper
 
+def login_rate_limited(func): # Decorator that throttles login/register before any database or bcrypt work
+    @wraps(func)
+    def login_rate_limited_wrapper(*args, **kwargs): # Wrapper function
+        if request.authorization: # Login sends basic auth
+            username = request.authorization.username
+        else: # Register sends JSON
+            data = request.get_json(silent=True)
+            username = data.get('username') if isinstance(data, dict) else None
+        wait = ip_limiter.take(request.remote_addr or "") # Client IP
+        if not wait and isinstance(username, str): # Username, counted separately
+            wait = username_limiter.take(username.lower())
+        if wait: # Over either limit
+            response = make_response(jsonify({'error': 'Too many attempts, try again later'}), 429)
+            response.headers['Retry-After'] = str(int(wait) + 1) # Seconds
+            return response
+        return func(*args, **kwargs) # Call original function
+    return login_rate_limited_wrapper
+
+def cached_response(func): # Decorator for caching GET responses
+    @wraps(func)
+    def cached_response_wrapper(*args, **kwargs): # Wrapper function
+        key = (request.path, tuple(sorted(request.args.items(multi=True)))) # Route plus normalized query args
+        cached = response_cache.get(key) # Check cache
+        if cached is not None: # If cached
+            body, status = cached
+            return app.response_class(body, status=status, mimetype="application/json")
+        response = func(*args, **kwargs) # Call original function
+        if response.status_code == 200: # Only successful responses are cached
+            response_cache.set(key, kwargs.get("city_id"), response.get_data(), response.status_code)
+        return response
+    return cached_response_wrapper
+
+def invalidates_cache(city_list=False): # Decorator for routes that change a city's data
+    def decorator(func):
+        @wraps(func)
+        def invalidates_cache_wrapper(*args, **kwargs): # Wrapper function
+            response = func(*args, **kwargs) # Call original function
+            if kwargs.get("city_id"): # Cached reads of this city are stale
+                response_cache.invalidate(kwargs["city_id"])
+                flag_index.invalidate(kwargs["city_id"])
+            if city_list: # Cached city lists are stale
+                response_cache.invalidate(None)
+            return response
+        return invalidates_cache_wrapper
+    return decorator
+
 ''''''
 # Authentication routes
 ''''''
 @app.route("/api/register", methods=['POST'])
+@login_rate_limited
 def register():
     data = request.get_json()
     
@@ -263,32 +1613,36 @@ def register():
     if not all(field in data for field in required_fields):
         return make_response(jsonify({'message': 'Missing required fields. Required fields are: username, password, email, and name'}), 400)
 
-    # Check if username already exists
-    if users.find_one({'username': data['username']}):
-        return make_response(jsonify({'message': 'Username already exists'}), 409)
-    
-    # Check if email already exists
-    if users.find_one({'email': data['email']}):
-        return make_response(jsonify({'message': 'Email already registered'}), 409)
-    
     # Validate password length
     if len(data['password']) < 6:
         return make_response(jsonify({'message': 'Password must be at least 6 characters long'}), 400)
 
+    # Hash password in the bcrypt pool
+    try:
+        password = password_hasher.hash(data['password'])
+    except PasswordPoolFull: # Too many hashes waiting
+        return make_response(jsonify({'message': 'Server busy, try again shortly'}), 503)
+
     # Create new user
     new_user = {
         'name': data['name'],
         'username': data['username'],
         'email': data['email'],
-        'password': bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()),
+        'password': password,
         'admin': data.get('admin', False),  # Default to False if not specified
         'created_at': datetime.datetime.now(datetime.UTC)
     }
     
     try:
-        # Insert the new user
+        # Insert the new user, the unique indexes on username and email reject duplicates
         users.insert_one(new_user)
-        
+    except DuplicateKeyError as e: # Username or email already taken
+        key = (e.details or {}).get('keyPattern') or {}
+        if 'email' in key or 'email_unique' in str(e): # Email index
+            return make_response(jsonify({'message': 'Email already registered'}), 409)
+        return make_response(jsonify({'message': 'Username already exists'}), 409)
+
+    try:
         # Generate token for the new user
         token = jwt.encode({
             'user': new_user['username'],
@@ -312,6 +1666,7 @@ def register():
 
 # Login route
 @app.route("/api/login", methods=['GET']) 
+@login_rate_limited
 def login(): # Login function
     auth = request.authorization # Get auth info
 
@@ -319,10 +1674,21 @@ def login(): # Login function
         user = users.find_one({'username': auth.username}) # Find user
         
         if user: # If user found
-            if bcrypt.checkpw( # Check password
-                bytes(auth.password, 'UTF-8'), # Convert password to bytes
-                user["password"] # Stored password hash
-            ):
+            try: # Check password in the bcrypt pool
+                password_ok = password_hasher.check(auth.password, user["password"])
+            except PasswordPoolFull: # Too many hashes waiting
+                return make_response(jsonify({'error': 'Server busy, try again shortly'}), 503)
+            if password_ok:
+                if password_hasher.needs_rehash(user["password"]): # Cost changed since the hash was made
+                    try:
+                        users.update_one( # Only if the hash hasn't changed meanwhile
+                            {'_id': user['_id'], 'password': user['password']},
+                            {'$set': {'password': password_hasher.hash(auth.password)}}
+                        )
+                        with password_hasher.lock:
+                            password_hasher.stats["rehashed"] += 1
+                    except PasswordPoolFull: # Try again on a later login
+                        pass
                 token = jwt.encode( # Create JWT token
                     {
                         'user': auth.username, # Username
@@ -345,14 +1711,32 @@ def login(): # Login function
 #@jwt_required # Requires valid token
 def logout(): # Logout function
     token = request.headers['x-access-token'] # Get token
-    blacklist.insert_one({"token": token}) # Add to blacklist
+    try: # Read expiry so the blacklist entry can age out
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"], options={"verify_exp": False})
+    except jwt.InvalidTokenError: # If token invalid
+        return make_response(jsonify({"error": "Token is invalid"}), 401)
+    blacklist.insert_one({ # Add to blacklist
+        "token": token,
+        "exp": datetime.datetime.fromtimestamp(data["exp"], datetime.UTC) # Removed by the TTL index after this
+    })
+    revocation_cache.add(token, data["exp"]) # Rejected by this process straight away
     return make_response(jsonify({'message': 'Logout successful'}), 200)
 
+# Login throttling and password pool counters
+@app.route("/api/auth/stats", methods=["GET"])
+def show_auth_stats(): # Function to show authentication counters
+    return make_response(jsonify({
+        "username_limiter": username_limiter.info(),
+        "ip_limiter": ip_limiter.info(),
+        "password_pool": password_hasher.info()
+    }), 200)
+
 ''''''
 # City routes
 ''''''
 # Gets all cities with pagination, optional filtering, and sorting
 @app.route("/api/cities", methods=["GET"]) # Route to cities, uses GET method
+@cached_response
 def show_all_cities(): # Function to show all cities
     try: # Try to handle potential errors
         # Get pagination parameters from request
@@ -381,32 +1765,35 @@ def show_all_cities(): # Function to show all cities
         sort_order = request.args.get('sort_order', 'asc')
         sort_direction = DESCENDING if sort_order.lower() == 'desc' else ASCENDING # Set sort based on the 'sort_order'
         
-        # Counts the total cities matching the query for pagination purposes
-        total_cities = businesses.count_documents(query) # Gets the total count of matching cities
-        if total_cities == 0:
-                return make_response(jsonify({"message": "No cities were found matching the criteria."}), 404)
-        
-        # Retrieve matching cities from the database with pagination and sorting
-        cities_taken = businesses.find(query) \
-            .sort(sort_field, sort_direction) \
-            .skip(page_start) \
-            .limit(page_size) # Applies sorting, pagination, and filters
+        # Continues after the cursor if provided, otherwise skips to the page number
+        cursor = request.args.get('cursor') # Opaque cursor from the previous page
+        after = cursor_condition(cursor, sort_field, sort_direction) if cursor else None
+        include_total = request.args.get('include_total', 'true').lower() != 'false' # Total can be skipped
+        
+        # Retrieve matching cities and their total count from the database in one round trip
+        cities_taken, total_cities, more_cities = find_page( # Applies sorting, pagination, and filters
+            businesses, query,
+            [(sort_field, sort_direction), ("_id", sort_direction)],
+            0 if cursor else page_start, page_size,
+            after=after, include_total=include_total
+        )
 
-        # Converts to a list and ObjectId fields to strings using the helper function
-        data_to_return = [convert_objectid_to_str(city) for city in cities_taken]
+        # Cities are returned as stored, the JSON provider converts ObjectIds
+        data_to_return = cities_taken
 
-        # Returns a 404 status code if no cities found
-        if not data_to_return: # Checks if the data list is empty
+        # Returns a 404 status code if no cities found, an empty page after a cursor is just the end of the list
+        if not data_to_return and not cursor: # Checks if the data list is empty
             return make_response(jsonify({"message": "No cities were found matching the criteria."}), 404)
 
         # Returns the paginated results with city data as JSON response
         return make_response(jsonify({
             'cities': data_to_return, # List of cities with places and related data
             'pagination': { # Pagination information
-                'current_page': page_num,
-                'total_pages': (total_cities + page_size - 1) // page_size, # Calculates the total pages
+                'current_page': None if cursor else page_num, # Unknown when paging by cursor
+                'total_pages': (total_cities + page_size - 1) // page_size if total_cities is not None else None, # Calculates the total pages
                 'page_size': page_size,
-                'total_items': total_cities 
+                'total_items': total_cities,
+                'next_cursor': next_page_cursor(cities_taken, sort_field, more_cities) # Cursor for the next page
             }}), 200)
 
     except ValueError as value_err: # Handles invalid parameter values
@@ -417,6 +1804,7 @@ def show_all_cities(): # Function to show all cities
 
 # Gets a specific city by ID with filters
 @app.route("/api/cities/<city_id>", methods=["GET"])
+@cached_response
 def show_one_city(city_id): 
     try: 
         # Validates the ObjectId format
@@ -426,15 +1814,12 @@ def show_one_city(city_id):
             }), 400)
 
         # Gets city from database
-        city = businesses.find_one({"_id": ObjectId(city_id)}) # Find city by ID
+        city = businesses.find_one({"_id": ObjectId(city_id)}, {"city_id": 1, "city_name": 1}) # Find city by ID
         if not city: # If city not found
             return make_response(jsonify({ # Return error response
                 "error": f"City with ID {city_id} not found"
             }), 404)
 
-        # Processes ObjectId fields
-        city = convert_objectid_to_str(city) # Convert ObjectIds to strings
-
         # Gets filter parameters
         include_places = request.args.get('include_places', 'false').lower() == 'true' # Whether to include places
         min_rating = float(request.args.get('min_rating', 0)) # Minimum rating filter
@@ -452,17 +1837,38 @@ def show_one_city(city_id):
                 'filters_applied': None # No filters used
             }), 200)
 
-        # Processes and filters places
+        # Gets pagination parameters
+        page_num, page_size = validate_pagination_params( # Get and validate pagination
+            request.args.get('pn'), # Page number from request
+            request.args.get('ps') # Page size from request
+        )
+        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
+
+        # Filters places in the database
+        query = { # Places in this city within the rating range
+            "city_id": ObjectId(city_id),
+            "ratings.average_rating": {"$gte": min_rating, "$lte": max_rating}
+        }
+        if place_type: # Case-insensitive exact type match, a tight range on the index
+            query["type_keys"] = type_key(place_type)
+
+        # Continues after the cursor if provided, otherwise skips to the page number
+        sort = [("info.name", ASCENDING), ("_id", ASCENDING)] # Sorted by name
+        cursor = request.args.get('cursor') # Opaque cursor from the previous page
+        after = cursor_condition(cursor, "info.name", ASCENDING) if cursor else None
+        include_total = request.args.get('include_total', 'true').lower() != 'false' # Total can be skipped
+
+        # Gets only the matching page of places
+        results, total_places, more_places = find_page(
+            places_collection, query, sort,
+            0 if cursor else page_start, page_size,
+            after=after, projection=CITY_PLACE_PROJECTION, include_total=include_total
+        )
+
+        # Processes places
         filtered_places = [] # Initialize filtered places list
-        for place in city.get('places', []): # Loop through each place
-            # Checks rating criteria
+        for place in results: # Loop through each place on the page
             rating = place.get('ratings', {}).get('average_rating') # Get place rating
-            if rating is None or not (min_rating <= rating <= max_rating): # If rating doesn't match
-                continue # Skip this place
-
-            # Checks place type criteria
-            if place_type and place_type.lower() not in [t.lower() for t in place.get('info', {}).get('type', [])]:
-                continue # Skip if type doesn't match
 
             # Creates place data object
             place_data = { # Structure place information
@@ -489,6 +1895,13 @@ def show_one_city(city_id):
                 'city_name': city.get('city_name'), # City name
                 'places': filtered_places # Filtered places list
             },
+            'pagination': { # Pagination information
+                'current_page': None if cursor else page_num, # Current page number, unknown when paging by cursor
+                'total_pages': (total_places + page_size - 1) // page_size if total_places is not None else None, # Total pages
+                'page_size': page_size, # Items per page
+                'total_items': total_places, # Total places count
+                'next_cursor': next_page_cursor(results, "info.name", more_places) # Cursor for the next page
+            },
             'includes': {'places': True}, # Indicates places included
             'filters_applied': { # Applied filter values
                 'min_rating': min_rating if min_rating > 0 else None, # Minimum rating if set
@@ -514,6 +1927,7 @@ def show_one_city(city_id):
 # Creates a new city
 @app.route("/api/cities", methods=["POST"])
 #@jwt_required 
+@invalidates_cache(city_list=True)
 def create_new_city(): 
     try: 
         # Validates JSON request
@@ -531,9 +1945,9 @@ def create_new_city():
         # Creates city document structure
         city_document = { # Initialize city document
             "city_id": city_data["city_id"], # Set city ID
-            "city_name": city_data["city_name"], # Set city name
-            "places": [] # Empty places array
+            "city_name": city_data["city_name"] # Set city name
         }
+        city_places = [] # Places to insert into the places collection
 
         # Processes places if provided
         if "places" in city_data: # If places included in request
@@ -570,6 +1984,7 @@ def create_new_city():
                     "amenities": place.get("amenities", {}), # Amenities if provided
                     "ratings": { 
                         "average_rating": 0, # Default rating
+                        "rating_sum": 0, # Default sum of ratings
                         "review_count": 0, # Default review count
                         "recent_reviews": [] # Empty reviews array
                     },
@@ -581,17 +1996,33 @@ def create_new_city():
                     ratings = place["ratings"] # Get ratings data
                     clean_place["ratings"]["average_rating"] = float(ratings.get("average_rating", 0)) # Set rating
                     clean_place["ratings"]["review_count"] = int(ratings.get("review_count", 0)) # Set count
+                    clean_place["ratings"]["rating_sum"] = \
+                        clean_place["ratings"]["average_rating"] * clean_place["ratings"]["review_count"] # Running sum
                     clean_place["ratings"]["recent_reviews"] = ratings.get("recent_reviews", []) # Set reviews
 
                 # Processes media if provided
                 if "media" in place and "photos" in place["media"]: # If photos included
                     clean_place["media"]["photos"] = place["media"]["photos"] # Set photos
 
-                city_document["places"].append(clean_place) # Add clean place to city
+                city_places.append(clean_place) # Add clean place to list
 
         # Inserts city into database
         result = businesses.insert_one(city_document) # Insert new city
 
+        # Inserts the city's places, keyed by the new city ID
+        if city_places: # If any places provided
+            for place in city_places: # Link each place to the city
+                place["_id"] = ObjectId() # New place ID
+                place["city_id"] = result.inserted_id
+                set_derived_fields(place) # Geo point and opening intervals
+                split_place_reviews(place) # Move provided reviews to the reviews collection
+            places_collection.insert_many(city_places) # Insert all places in one call
+
+        # Adds the new names to the autocomplete index
+        name_index.add_city(result.inserted_id, city_document["city_name"])
+        for place in city_places:
+            name_index.add_place(place["_id"], place["city_id"], get_field(place, "info.name") or "")
+
         # Returns success response
         return make_response(jsonify({ # Create success response
             "message": "City created successfully", # Success message
@@ -608,6 +2039,7 @@ def create_new_city():
 # Updates an existing city
 @app.route("/api/cities/<city_id>", methods=["PUT"]) 
 #@jwt_required
+@invalidates_cache(city_list=True)
 def update_city(city_id): 
     try: # Try to handle potential errors
         # Validates the ObjectId format
@@ -632,6 +2064,7 @@ def update_city(city_id):
             update_fields["city_name"] = update_data["city_name"] # Add name update
 
         # Updates places if provided
+        new_places = None # Replacement places list
         if "places" in update_data: # If places update provided
             for place in update_data["places"]: # Process each place
                 # Validates required place fields
@@ -651,26 +2084,37 @@ def update_city(city_id):
                     except (ValueError, TypeError): # If conversion fails
                         return make_response(jsonify({ "error": "Invalid coordinates format"}), 400)
 
-            update_fields["places"] = update_data["places"] # Add places update
+            new_places = update_data["places"] # Add places update
 
         # Checks if any valid updates provided
-        if not update_fields: # If no valid updates
+        if not update_fields and new_places is None: # If no valid updates
             return make_response(jsonify({"error": "No valid update fields provided"}), 400)
 
         # Updates city in database
-        result = businesses.update_one( # Perform update
-            {"_id": ObjectId(city_id)}, # Find city by ID
-            {"$set": update_fields} # Set new values
-        )
+        if update_fields: # If city fields changed
+            result = businesses.update_one( # Perform update
+                {"_id": ObjectId(city_id)}, # Find city by ID
+                {"$set": update_fields} # Set new values
+            )
+            matched_count = result.matched_count
+        else: # Only places changed
+            matched_count = businesses.count_documents({"_id": ObjectId(city_id)}, limit=1)
 
         # Checks update result
-        if result.matched_count == 0: # If city not found
+        if matched_count == 0: # If city not found
             return make_response(jsonify({"error": "City not found"}), 404)
 
+        # Replaces the city's places
+        updated_fields = list(update_fields.keys()) # Names of updated fields
+        if new_places is not None: # If places update provided
+            replace_city_places(ObjectId(city_id), new_places)
+            updated_fields.append("places")
+        name_index.reset() # Names may have changed, reload them on next lookup
+
         # Returns success response
         return make_response(jsonify({ # Return success response
             "message": "City updated successfully",
-            "updated_fields": list(update_fields.keys())
+            "updated_fields": updated_fields
         }), 200)
 
     except ValueError as err: # Handles value errors
@@ -690,6 +2134,7 @@ def update_city(city_id):
 @app.route("/api/cities/<city_id>", methods=["DELETE"]) 
 #@jwt_required
 #@admin_required
+@invalidates_cache(city_list=True)
 def delete_city(city_id): 
     try:
         if not is_valid_objectid(city_id):
@@ -699,6 +2144,9 @@ def delete_city(city_id):
         # Check if city was found and deleted
         if result.deleted_count == 0: # If no document was deleted
             return make_response(jsonify({"error": "City not found"}), 404) 
+        places_collection.delete_many({"city_id": ObjectId(city_id)}) # Delete the city's places
+        reviews_collection.delete_many({"city_id": ObjectId(city_id)}) # Delete the city's reviews
+        name_index.reset() # Drop the city's names on next lookup
         return make_response(jsonify({"message": "City deleted successfully"}), 200)    
         
     except Exception as err: # Handle any errors
@@ -707,199 +2155,407 @@ def delete_city(city_id):
 ''''''
 # Place route
 ''''''
+# Lists places matching a query, with the filters, sorting and pagination from the request
+def list_places(query):
+    # Gets pagination parameters
+    page_num, page_size = validate_pagination_params( # Get and validate pagination
+        request.args.get('pn'), # Page number from request
+        request.args.get('ps') # Page size from request
+    )
+    page_start = (page_size * (page_num - 1)) # Calculate pagination start point
+
+    # Adds type, rating and service filters if provided
+    try: # Filters come from the client
+        match_conditions, filters_applied = place_filter_conditions(request.args)
+    except ValueError as err: # If a filter value is invalid
+        return make_response(jsonify({"error": str(err)}), 400)
+
+    # Adds match conditions to query
+    if match_conditions: # If any conditions exist
+        query["$and"] = match_conditions # Must match all conditions
+
+    # Adds sorting stage
+    valid_sort_fields = { # Define valid sort fields and their paths
+        'name': 'info.name', # Sort by place name
+        'rating': 'ratings.average_rating', # Sort by rating
+        'review_count': 'ratings.review_count', # Sort by number of reviews
+        'score': 'ratings.score' # Sort by Bayesian score
+    }
+
+    # Gets requested sort field
+    requested_sort = request.args.get('sort_by', 'name') # Get sort field or default to name
+    sort_field = valid_sort_fields.get(requested_sort, valid_sort_fields['name']) # Get valid path or default
+
+    # Gets sort direction
+    sort_order = request.args.get('sort_order', 'asc').lower() # Get sort order or default
+    sort_direction = -1 if sort_order == 'desc' else 1 # Convert to MongoDB sort value
+
+    # Continues after the cursor if provided, otherwise skips to the page number
+    cursor = request.args.get('cursor') # Opaque cursor from the previous page
+    try: # Cursor comes from the client
+        after = cursor_condition(cursor, sort_field, sort_direction) if cursor else None
+    except ValueError: # If cursor malformed
+        return make_response(jsonify({"error": "Invalid cursor"}), 400)
+    include_total = request.args.get('include_total', 'true').lower() != 'false' # Total can be skipped
+
+    # Executes indexed query with sorting, pagination and total count in one round trip
+    results, total_places, more_places = find_page(
+        places_collection, query,
+        [(sort_field, sort_direction), ("_id", sort_direction)],
+        0 if cursor else page_start, page_size,
+        after=after, projection=PLACE_PROJECTION, include_total=include_total
+    )
+
+    # Processes results
+    moment = reference_time(request.args) # Time the opening status is worked out for
+    places = [set_opening_status(place, moment) for place in results] # IDs are converted by the JSON provider
+
+    # Adds sort to filters_applied
+    filters_applied['sort'] = { # Track sort options
+        'field': requested_sort, # Original requested field
+        'direction': sort_order # Sort direction
+    }
+
+    # Returns response
+    return make_response(jsonify({ 
+        'places': places, # List of places
+        'pagination': { # Pagination information
+            'current_page': None if cursor else page_num, # Current page number, unknown when paging by cursor
+            'total_pages': (total_places + page_size - 1) // page_size if total_places is not None else None, # Total pages
+            'page_size': page_size, # Items per page
+            'total_items': total_places, # Total items count
+            'next_cursor': next_page_cursor(results, sort_field, more_places) # Cursor for the next page
+        },
+        'filters_applied': filters_applied # All applied filters including sort
+    }), 200)
+
 # Gets all food places within a city
 @app.route("/api/cities/<city_id>/places", methods=["GET"]) 
+@cached_response
 def show_all_places(city_id): # Takes city_id as its parameter
     try: 
         if not ObjectId.is_valid(city_id): # Check if ID format is valid
             return make_response(jsonify({"error": "Invalid city ID"}), 200)
         
-        # Gets pagination parameters
-        page_num, page_size = validate_pagination_params( # Get and validate pagination
-            request.args.get('pn'), # Page number from request
-            request.args.get('ps') # Page size from request
-        )
-        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
-        
-        # Sets up aggregation pipeline
-        pipeline = [] # Initialize pipeline list
-        pipeline.append({ # Add city matching stage
-            "$match": {"_id": ObjectId(city_id)} # Find specific city
-        })
-        pipeline.append({ # Add places unwinding stage
-            "$unwind": "$places" # Split places array
-        })
-        
-        # Adds filters if provided
-        match_conditions = [] # Initialize conditions list
-        filters_applied = {} # Track all applied filters
-        
-        # Adds place type filter
-        place_type = request.args.get('type') # Get type parameter
-        if place_type: # If type provided
-            match_conditions.append({ # Add type condition
-                "places.info.type": place_type # Match place type
-            })
-            filters_applied['type'] = place_type # Track type filter
-            
-        # Adds rating filter
-        min_rating = request.args.get('min_rating') # Get rating parameter
-        if min_rating: # If rating provided
-            try: # Try to convert rating
-                min_rating_float = float(min_rating) # Convert to float
-                match_conditions.append({ # Add rating condition
-                    "places.ratings.average_rating": {
-                        "$gte": min_rating_float # Match minimum rating
-                    }
-                })
-                filters_applied['min_rating'] = min_rating_float # Track rating filter
-            except ValueError: # If rating conversion fails
-                return make_response(jsonify({ # Return error response
-                    "error": "Invalid rating value"
-                }), 400)
-        
-        # Sets up service filters
-        service_filters = { # Define available service options
-            'service_options': {
-                'dining': {
-                    'dine_in': 'service_options.dining.dine_in',
-                    'takeaway': 'service_options.dining.takeaway',
-                    'reservations': 'service_options.dining.reservations',
-                    'outdoor_seating': 'service_options.dining.outdoor_seating',
-                    'group_bookings': 'service_options.dining.group_bookings'
-                },
-                'meals': {
-                    'breakfast': 'service_options.meals.breakfast',
-                    'lunch': 'service_options.meals.lunch',
-                    'dinner': 'service_options.meals.dinner',
-                    'brunch': 'service_options.meals.brunch'
+        return list_places({"city_id": ObjectId(city_id)}) # Places in this city
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({ # Return error response
+            "error": "Server error",
+            "message": str(err)
+        }), 500)
+
+# Gets food places from every city, with the same filters, sorting and pagination as a single city
+@app.route("/api/places", methods=["GET"])
+def show_places(): # Function to show places across cities
+    try:
+        return list_places({}) # Any city, the cross-city indexes serve the filters and sorts
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({ # Return error response
+            "error": "Server error",
+            "message": str(err)
+        }), 500)
+
+# Gets the best places of a city by Bayesian score, read in order from the city_score index
+@app.route("/api/cities/<city_id>/top", methods=["GET"])
+@cached_response
+def show_top_places(city_id): # Function to show top places
+    try:
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
+            return make_response(jsonify({"error": "Invalid city ID"}), 400)
+        try: # Count comes from the client
+            n = min(max(int(request.args.get('n', 10)), 1), 50) # Between 1 and 50
+        except ValueError: # If n not a number
+            return make_response(jsonify({"error": "n must be a number"}), 400)
+
+        places = list(places_collection.find({"city_id": ObjectId(city_id)}, PLACE_PROJECTION)
+                      .sort([("ratings.score", DESCENDING), ("_id", DESCENDING)]).limit(n))
+        if not places and not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+            return make_response(jsonify({"error": "City not found"}), 404)
+
+        moment = reference_time({}) # Opening status for now
+        return make_response(jsonify({
+            "places": [set_opening_status(place, moment) for place in places], # Best first
+            "n": n
+        }), 200)
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
+# Counts a city's places for any mix of service, menu and amenity flags, and what ticking each other flag would give
+@app.route("/api/cities/<city_id>/places/flags", methods=["GET"])
+def show_flag_counts(city_id): # Function to count flag combinations
+    try:
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
+            return make_response(jsonify({"error": "Invalid city ID"}), 400)
+
+        required, excluded, filters_applied = flag_masks(request.args) # Flags selected so far
+        selected, bitmaps = flag_index.select(city_id, required, excluded) # Served from memory
+
+        return make_response(jsonify({
+            "total": selected.bit_count(), # Places matching every selected flag
+            **{group: { # service_options, menu_options and amenities
+                category: {
+                    option: (selected & bitmaps[FLAG_BITS[f"{group}.{category}.{option}"]]).bit_count()
+                    for option in options
                 }
-            }
-        }
-        
-        # Processes service filters
-        for category, options in service_filters['service_options'].items(): # For each service category
-            category_filters = {} # Track filters for this category
-            for option, path in options.items(): # For each option in category
-                value = request.args.get(option, '').lower() # Get parameter value
-                if value in ['true', 'false']: # If valid boolean string
-                    match_conditions.append({ # Add filter condition
-                        f"places.{path}": value == 'true' # Match boolean value
-                    })
-                    category_filters[option] = value == 'true' # Track filter value
-            
-            if category_filters: # If any filters applied in this category
-                if 'service_options' not in filters_applied: # If first service filter
-                    filters_applied['service_options'] = {} # Initialize service options
-                filters_applied['service_options'][category] = category_filters # Track category filters
-            
-        # Adds match conditions to pipeline
-        if match_conditions: # If any conditions exist
-            pipeline.append({ # Add filter conditions
-                "$match": {"$and": match_conditions} # Must match all conditions
-            })
-            
-        # Adds sorting stage
-        valid_sort_fields = { # Define valid sort fields and their paths
-            'name': 'places.info.name', # Sort by place name
-            'rating': 'places.ratings.average_rating', # Sort by rating
-            'review_count': 'places.ratings.review_count' # Sort by number of reviews
-        }
-        
-        # Gets requested sort field
-        requested_sort = request.args.get('sort_by', 'name') # Get sort field or default to name
-        sort_field = valid_sort_fields.get(requested_sort, valid_sort_fields['name']) # Get valid path or default
-        
-        # Gets sort direction
-        sort_order = request.args.get('sort_order', 'asc').lower() # Get sort order or default
-        sort_direction = -1 if sort_order == 'desc' else 1 # Convert to MongoDB sort value
-        
-        # Adds sort to pipeline
-        pipeline.append({"$sort": {sort_field: sort_direction}})
-        
-        # Adds pagination stages
-        pipeline.append({"$skip": page_start}) # Skip to page start
-        pipeline.append({"$limit": page_size}) # Limit results per page
-        
-        # Executes pipeline
-        results = list(businesses.aggregate(pipeline)) # Run aggregation
-        
-        # Processes results
-        places = [] 
-        for result in results: # For each result
-            if 'places' in result: # If result has places
-                place = result['places'] # Get place data
-                place = convert_objectid_to_str(place) # Convert IDs to strings
-                places.append(place) # Add to places list
-            
-        # Gets total count for pagination
-        count_pipeline = pipeline[:-2] # Remove pagination stages
-        count_pipeline.append({"$count": "total"}) # Add count stage
-        total_count = list(businesses.aggregate(count_pipeline)) # Get total count
-        total_places = total_count[0]['total'] if total_count else 0 # Extract count
-        
-        # Adds sort to filters_applied
-        filters_applied['sort'] = { # Track sort options
-            'field': requested_sort, # Original requested field
-            'direction': sort_order # Sort direction
+                for category, options in categories.items()
+            } for group, categories in FLAG_FILTERS.items()},
+            "filters_applied": filters_applied
+        }), 200)
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
+# Rating ranges counted by the facets route, the last one includes 5
+RATING_BUCKETS = [0, 1, 2, 3, 4, 4.5, 5.01]
+
+# Counts how many places of a city each filter option would give, for the filter sidebar
+@app.route("/api/cities/<city_id>/places/facets", methods=["GET"])
+@cached_response
+def show_place_facets(city_id): # Function to count filter options
+    try:
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
+            return make_response(jsonify({"error": "Invalid city ID"}), 400)
+
+        # Gets the filters already selected
+        try: # Filters come from the client
+            match_conditions, filters_applied = place_filter_conditions(request.args)
+        except ValueError as err: # If a filter value is invalid
+            return make_response(jsonify({"error": str(err)}), 400)
+
+        def selected(skip=None): # Match stage for the selected filters, leaving out one field
+            conditions = [condition for condition in match_conditions if skip not in condition]
+            return {"$match": {"$and": conditions} if conditions else {}}
+
+        # Flags are combined with AND, so each count is what ticking that flag as well would give
+        flag_counts = {
+            f"flag_{bit}": {"$sum": {"$cond": [{"$eq": [f"${path}", True]}, 1, 0]}}
+            for path, bit in FLAG_BITS.items()
         }
-        
+
+        # Counts every facet in one aggregation, type and rating ignore their own filter so other choices still show
+        result = next(places_collection.aggregate([
+            {"$match": {"city_id": ObjectId(city_id)}}, # Places in this city
+            {"$facet": {
+                "total": [selected(), {"$count": "count"}],
+                "types": [
+                    selected("info.type"),
+                    {"$unwind": "$info.type"}, # One row per type of each place
+                    {"$group": {"_id": "$info.type", "count": {"$sum": 1}}},
+                    {"$sort": {"count": -1, "_id": 1}}
+                ],
+                "flags": [selected(), {"$group": dict(flag_counts, _id=None)}],
+                "ratings": [
+                    selected("ratings.average_rating"),
+                    {"$bucket": {
+                        "groupBy": "$ratings.average_rating",
+                        "boundaries": RATING_BUCKETS,
+                        "default": "unrated", # Missing or out of range ratings
+                        "output": {"count": {"$sum": 1}}
+                    }}
+                ]
+            }}
+        ]))
+
+        # Shapes the counts
+        flags = result["flags"][0] if result["flags"] else {} # No places gives no row
+        ratings = {bucket["_id"]: bucket["count"] for bucket in result["ratings"]}
+        return make_response(jsonify({
+            "total": result["total"][0]["count"] if result["total"] else 0, # Places matching every filter
+            "types": [{"type": row["_id"], "count": row["count"]} for row in result["types"]],
+            **{group: { # service_options, menu_options and amenities
+                category: {option: flags.get(f"flag_{FLAG_BITS[f'{group}.{category}.{option}']}", 0) for option in options}
+                for category, options in categories.items()
+            } for group, categories in FLAG_FILTERS.items()},
+            "ratings": [
+                {"min": low, "max": min(high, 5), "count": ratings.get(low, 0)}
+                for low, high in zip(RATING_BUCKETS, RATING_BUCKETS[1:])
+            ],
+            "filters_applied": filters_applied
+        }), 200)
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
+# Gets food places near a position across all cities, nearest first
+@app.route("/api/places/near", methods=["GET"])
+def show_places_near(): # Function to show places by distance
+    try:
+        # Gets the position and search radius
+        try: # Values come from the client
+            latitude = float(request.args['lat']) # Latitude in degrees
+            longitude = float(request.args['lng']) # Longitude in degrees
+            radius = float(request.args.get('radius', 1000)) # Radius in metres
+        except KeyError: # If position missing
+            return make_response(jsonify({"error": "lat and lng are required"}), 400)
+        except ValueError: # If a value is not a number
+            return make_response(jsonify({"error": "lat, lng and radius must be numbers"}), 400)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180): # Outside the globe
+            return make_response(jsonify({"error": "Invalid position"}), 400)
+        if not 0 < radius <= 50000: # Keep searches local
+            return make_response(jsonify({"error": "radius must be between 0 and 50000 metres"}), 400)
+
+        # Gets pagination parameters
+        page_num, page_size = validate_pagination_params(request.args.get('pn'), request.args.get('ps'))
+        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
+
+        # Adds type, rating and service filters if provided
+        try: # Filters come from the client
+            match_conditions, filters_applied = place_filter_conditions(request.args)
+        except ValueError as err: # If a filter value is invalid
+            return make_response(jsonify({"error": str(err)}), 400)
+        query = {"$and": match_conditions} if match_conditions else {} # Any city
+
+        # Sorts by distance using the geo index, filters are applied inside $geoNear
+        pipeline = [{"$geoNear": {
+            "near": {"type": "Point", "coordinates": [longitude, latitude]},
+            "key": "location.point",
+            "distanceField": "distance", # Metres from the position
+            "maxDistance": radius,
+            "spherical": True,
+            "query": query
+        }}]
+        page_stages = [{"$skip": page_start}, {"$limit": page_size}, {"$project": PLACE_PROJECTION}]
+        include_total = request.args.get('include_total', 'true').lower() != 'false' # Total can be skipped
+        if include_total: # Page and total from the same pass
+            pipeline.append({"$facet": {"items": page_stages, "total": [{"$count": "count"}]}})
+            result = next(places_collection.aggregate(pipeline))
+            places = result["items"]
+            total_places = result["total"][0]["count"] if result["total"] else 0 # No matches gives no count row
+        else: # Page only
+            places = list(places_collection.aggregate(pipeline + page_stages))
+            total_places = None
+
+        moment = reference_time(request.args) # Time the opening status is worked out for
+        places = [set_opening_status(place, moment) for place in places]
+        filters_applied['near'] = {'lat': latitude, 'lng': longitude, 'radius': radius} # Track position
+
         # Returns response
-        return make_response(jsonify({ 
-            'places': places, # List of places
-            'pagination': { # Pagination information
-                'current_page': page_num, # Current page number
-                'total_pages': (total_places + page_size - 1) // page_size, # Total pages
-                'page_size': page_size, # Items per page
-                'total_items': total_places # Total items count
+        return make_response(jsonify({
+            'places': places, # Places with their distance in metres
+            'pagination': {
+                'current_page': page_num,
+                'total_pages': (total_places + page_size - 1) // page_size if include_total else None,
+                'page_size': page_size,
+                'total_items': total_places
             },
-            'filters_applied': filters_applied # All applied filters including sort
+            'filters_applied': filters_applied
         }), 200)
 
     except Exception as err:
         print(f"Error occurred: {err}") # Log the error
-        return make_response(jsonify({ # Return error response
-            "error": "Server error",
-            "message": str(err)
-        }), 500)
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
+# Searches places in all cities by name, type, address and recent review content, best matches first
+@app.route("/api/search", methods=["GET"])
+def search_places(): # Function to search places
+    try:
+        search = request.args.get('q', '').strip() # Search words
+        if not search: # If nothing to search for
+            return make_response(jsonify({"error": "q is required"}), 400)
+        if len(search) > 200: # Keep queries small
+            return make_response(jsonify({"error": "q must be at most 200 characters"}), 400)
+
+        # Gets pagination parameters
+        page_num, page_size = validate_pagination_params(request.args.get('pn'), request.args.get('ps'))
+        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
+
+        # Adds type, rating and service filters if provided
+        try: # Filters come from the client
+            match_conditions, filters_applied = place_filter_conditions(request.args)
+        except ValueError as err: # If a filter value is invalid
+            return make_response(jsonify({"error": str(err)}), 400)
+        query = {"$text": {"$search": search}} # Uses the place_text index
+        if match_conditions: # If any filters
+            query["$and"] = match_conditions
+
+        # Ranks by text score, page and total from one pass
+        results, total_places, _ = find_page(
+            places_collection, query,
+            [("score", {"$meta": "textScore"}), ("_id", ASCENDING)],
+            page_start, page_size,
+            projection=dict(PLACE_PROJECTION, score={"$meta": "textScore"})
+        )
+
+        # Gets the cities of the page in one query
+        cities = {city["_id"]: city for city in businesses.find(
+            {"_id": {"$in": list({place["city_id"] for place in results})}},
+            {"city_id": 1, "city_name": 1}
+        )}
+
+        # Returns response
+        moment = reference_time(request.args) # Time the opening status is worked out for
+        return make_response(jsonify({
+            'results': [{
+                'place': set_opening_status(place, moment),
+                'city': cities.get(place["city_id"]), # City the place belongs to
+                'score': place.pop("score") # Relevance
+            } for place in results],
+            'pagination': calculate_pagination(total_places, page_size, page_num),
+            'query': search,
+            'filters_applied': filters_applied
+        }), 200)
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
+# Suggests city and place names for a search box, typos included
+@app.route("/api/autocomplete", methods=["GET"])
+def autocomplete(): # Function to suggest names
+    prefix = request.args.get('prefix', '') # What has been typed so far
+    if not prefix.strip(): # If nothing typed
+        return make_response(jsonify({"error": "prefix is required"}), 400)
+    if len(prefix) > 100: # Keep lookups small
+        return make_response(jsonify({"error": "prefix must be at most 100 characters"}), 400)
+    try: # Limit comes from the client
+        limit = min(max(int(request.args.get('limit', 10)), 1), 20) # Between 1 and 20
+    except ValueError: # If limit not a number
+        return make_response(jsonify({"error": "limit must be a number"}), 400)
+    return make_response(jsonify({
+        "prefix": prefix,
+        "suggestions": name_index.lookup(prefix, limit) # Served from memory
+    }), 200)
 
 # Gets a specific food place from a city
 @app.route("/api/cities/<city_id>/places/<place_id>", methods=["GET"]) # Route to get specific place
+@cached_response
 def show_one_place(city_id, place_id): # Function to show single place details
     try: # Try to handle potential errors
-        print(f"Received city_id: {city_id}, place_id: {place_id}") # Debug print to check IDs
-        
         if not ObjectId.is_valid(city_id): # Check if city ID format is valid
             return make_response(jsonify({ # Return error response
                 "error": "Invalid city ID format"
             }), 404)
-            
-        # Find the city 
-        city = businesses.find_one({ # Find specific city
-            "_id": ObjectId(city_id) # Convert string to ObjectId
-        })
-        
-        if not city: # If city not found
-            return make_response(jsonify({ # Return error response
-                "error": "City not found"
-            }), 200)
 
+        if not ObjectId.is_valid(place_id): # Check if place ID format is valid
+            return make_response(jsonify({ # Return error response
+                "error": "Invalid place ID format"
+            }), 404)
+            
         # Find the specific place
-        place = None # Initialize place variable
-        for p in city.get('places', []): # Loop through places
-            if str(p.get('_id')) == place_id: # Compare as strings
-                place = p # Store found place
-                break # Exit loop
+        place = places_collection.find_one( # Only this place, straight from its _id
+            place_query(city_id, place_id), # Find place by ID within the city
+            PLACE_PROJECTION
+        )
                 
         if not place: # If place not found
+            if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+                return make_response(jsonify({ # Return error response
+                    "error": "City not found"
+                }), 200)
             return make_response(jsonify({ # Return error response
                 "error": "Place not found"
             }), 200)
 
-        # Convert ObjectIds to strings
-        place = convert_objectid_to_str(place) # Convert IDs in response
-        
         # Return the place data
+        set_opening_status(place, reference_time({})) # Open now and next opening
         return make_response(jsonify({ # Create JSON response
             "data": place, # Place details
             "links": { # Add HATEOAS links # Taken
@@ -918,6 +2574,7 @@ def show_one_place(city_id, place_id): # Function to show single place details
 # Adds a new food place to a city
 @app.route("/api/cities/<city_id>/places", methods=["POST"])
 #@jwt_required
+@invalidates_cache()
 def add_new_place(city_id): 
     try: 
         # Validates city ID format
@@ -981,6 +2638,7 @@ def add_new_place(city_id):
         # Sets default values if not provided
         place_data.setdefault('ratings', { # Initialize ratings
             'average_rating': 0,
+            'rating_sum': 0,
             'review_count': 0,
             'recent_reviews': []
         })
@@ -1027,22 +2685,17 @@ def add_new_place(city_id):
             }
         })
         
-        # Adds the place to the city
-        result = businesses.update_one( # Update the city document
-            {"_id": ObjectId(city_id)}, # Find city by ID
-            {"$push": {"places": place_data}} # Add new place to array
-        )
-        
-        # Checks if city was found and updated
-        if result.matched_count == 0: # If city not found
+        # Checks if city exists
+        if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
             return make_response(jsonify({ # Return error response
                 "error": "City not found"
             }), 200)
-            
-        if result.modified_count == 0: # If update failed
-            return make_response(jsonify({ # Return error response
-                "error": "Failed to add place"
-            }), 500)
+
+        # Adds the place to the places collection
+        place_data['city_id'] = ObjectId(city_id) # Link place to the city
+        set_derived_fields(place_data) # Geo point and opening intervals
+        places_collection.insert_one(place_data) # Insert new place
+        name_index.add_place(place_data['_id'], place_data['city_id'], place_data['info']['name']) # For autocomplete
         
         # Returns success response
         return make_response(jsonify({ # Create success response
@@ -1057,9 +2710,33 @@ def add_new_place(city_id):
             "message": str(err)
         }), 500)
 
+# Imports many places into a city from an NDJSON body, one place per line
+@app.route("/api/cities/<city_id>/places/import", methods=["POST"])
+#@jwt_required
+#@admin_required
+@invalidates_cache()
+def bulk_import_places(city_id): # Function to import places
+    try:
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
+            return make_response(jsonify({"error": "Invalid city ID format"}), 400)
+        try: # Batch size comes from the client
+            batch_size = min(max(int(request.args.get('batch_size', app.config['IMPORT_BATCH_SIZE'])), 1), 5000)
+        except ValueError: # If batch size not a number
+            return make_response(jsonify({"error": "batch_size must be a number"}), 400)
+        if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+            return make_response(jsonify({"error": "City not found"}), 404)
+
+        report = import_places(ObjectId(city_id), request.stream, batch_size) # Reads the body line by line
+        return make_response(jsonify(report), 200)
+
+    except Exception as err: # Handles unexpected errors
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
 # Updates a food place in a city
 @app.route("/api/cities/<city_id>/places/<place_id>", methods=["PUT"]) 
 #@jwt_required
+@invalidates_cache()
 def update_place(city_id, place_id):
     try: 
         # Validates IDs format
@@ -1083,7 +2760,7 @@ def update_place(city_id, place_id):
         if 'info' in update_data: # If info updates provided
             for field in ['name', 'type', 'status']: # For each info field
                 if field in update_data['info']: # If field provided
-                    update_fields[f"places.$.info.{field}"] = update_data['info'][field]
+                    update_fields[f"info.{field}"] = update_data['info'][field]
                     
         # Updates location if provided
         if 'location' in update_data: # If location updates provided
@@ -1091,11 +2768,11 @@ def update_place(city_id, place_id):
             if 'address' in location: # If address provided
                 for field in ['street', 'city', 'postcode', 'full_address']: # For each address field
                     if field in location['address']: # If field provided
-                        update_fields[f"places.$.location.address.{field}"] = location['address'][field]
+                        update_fields[f"location.address.{field}"] = location['address'][field]
             if 'coordinates' in location: # If coordinates provided
                 for field in ['latitude', 'longitude']: # For each coordinate
                     if field in location['coordinates']: # If coordinate provided
-                        update_fields[f"places.$.location.coordinates.{field}"] = float(location['coordinates'][field])
+                        update_fields[f"location.coordinates.{field}"] = float(location['coordinates'][field])
                         
         # Updates business hours if provided
         if 'business_hours' in update_data: # If hours updates provided
@@ -1103,7 +2780,7 @@ def update_place(city_id, place_id):
             for day in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']: # For each day
                 if day in hours: # If day provided
                     if 'open' in hours[day] and 'close' in hours[day]: # If both times provided
-                        update_fields[f"places.$.business_hours.{day}"] = hours[day]
+                        update_fields[f"business_hours.{day}"] = hours[day]
                         
         # Updates service options if provided
         if 'service_options' in update_data: # If service updates provided
@@ -1111,7 +2788,7 @@ def update_place(city_id, place_id):
             for category in ['dining', 'meals']: # For each category
                 if category in services: # If category provided
                     for option, value in services[category].items(): # For each option
-                        update_fields[f"places.$.service_options.{category}.{option}"] = bool(value)
+                        update_fields[f"service_options.{category}.{option}"] = bool(value)
                         
         # Updates menu options if provided
         if 'menu_options' in update_data: # If menu updates provided
@@ -1119,7 +2796,7 @@ def update_place(city_id, place_id):
             for category in ['food', 'drinks']: # For each category
                 if category in menu: # If category provided
                     for option, value in menu[category].items(): # For each option
-                        update_fields[f"places.$.menu_options.{category}.{option}"] = bool(value)
+                        update_fields[f"menu_options.{category}.{option}"] = bool(value)
                         
         # Updates amenities if provided
         if 'amenities' in update_data: # If amenities updates provided
@@ -1127,18 +2804,15 @@ def update_place(city_id, place_id):
             for category in ['facilities', 'accessibility']: # For each category
                 if category in amenities: # If category provided
                     for option, value in amenities[category].items(): # For each option
-                        update_fields[f"places.$.amenities.{category}.{option}"] = bool(value)
+                        update_fields[f"amenities.{category}.{option}"] = bool(value)
 
         # Checks if any updates were provided
         if not update_fields: # If no valid updates
             return make_response(jsonify({"error": "No valid update fields provided"}), 200)
 
         # Updates the place
-        result = businesses.update_one( # Update the document
-            {
-                "_id": ObjectId(city_id), # Find city by ID
-                "places._id": ObjectId(place_id) # Find place by ID
-            },
+        result = places_collection.update_one( # Update the place document
+            place_query(city_id, place_id), # Find place by ID within the city
             {"$set": update_fields} # Update specified fields
         )
 
@@ -1149,6 +2823,11 @@ def update_place(city_id, place_id):
         if result.modified_count == 0: # If no document modified
             return make_response(jsonify({"error": "No changes made to place"}), 400)
 
+        if any(field.startswith(DERIVED_FROM) for field in update_fields): # Derived fields are now stale
+            refresh_derived_fields(place_query(city_id, place_id))
+        if "info.name" in update_fields: # Name changed
+            name_index.add_place(ObjectId(place_id), ObjectId(city_id), update_fields["info.name"])
+
         # Returns success response
         return make_response(jsonify({
             "message": "Place updated successfully",
@@ -1167,6 +2846,7 @@ def update_place(city_id, place_id):
 @app.route("/api/cities/<city_id>/places/<place_id>", methods=["DELETE"]) 
 #@jwt_required
 #@admin_required
+@invalidates_cache()
 def delete_place(city_id, place_id):
     try: 
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
@@ -1175,33 +2855,16 @@ def delete_place(city_id, place_id):
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
             return make_response(jsonify({ "error": "Invalid place ID format"}), 200)
         
-        # Checks if city exists first
-        city = businesses.find_one({ # Find the city
-            "_id": ObjectId(city_id) # Using city ID
-        })
-        if not city: # If city not found
-            return make_response(jsonify({"error": "City not found"}), 404)
-            
-        # Checks if place exists in city
-        place_exists = any( # Check places array
-            str(place.get('_id')) == str(ObjectId(place_id)) # Compare place IDs
-            for place in city.get('places', []) # Loop through places
-        )
-        
-        if not place_exists: # If place not found
-            return make_response(jsonify({"error": "Place not found in city"}), 200)
-
         # Deletes the place
-        result = businesses.update_one( # Update city document
-            {"_id": ObjectId(city_id)}, # Find city by ID
-            {
-                "$pull": { "places": {"_id": ObjectId(place_id)}}
-            } # Match place by I
-        )
+        result = places_collection.delete_one(place_query(city_id, place_id)) # Delete place by ID within the city
     
         # Checks if operation was successful
-        if result.modified_count == 0: # If no document was modified
-            return make_response(jsonify({"error": "Failed to delete place"}), 500)
+        if result.deleted_count == 0: # If no document was deleted
+            if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+                return make_response(jsonify({"error": "City not found"}), 404)
+            return make_response(jsonify({"error": "Place not found in city"}), 200)
+        reviews_collection.delete_many({"place_id": ObjectId(place_id)}) # Delete the place's reviews
+        name_index.remove("place", ObjectId(place_id)) # Drop from autocomplete
         return make_response(jsonify({"message": "Place deleted successfully"}), 200) # Returns success response
         
     except Exception as err: # Handles unexpected errors
@@ -1215,6 +2878,7 @@ def delete_place(city_id, place_id):
 @app.route("/api/cities/<city_id>/places/<place_id>/status", methods=["PATCH"]) # Route to update place status
 #@jwt_required
 #@admin_required
+@invalidates_cache()
 def update_place_status(city_id, place_id): # Function to update place status
     try: # Try to handle potential errors
         # Validates IDs format
@@ -1250,13 +2914,10 @@ def update_place_status(city_id, place_id): # Function to update place status
             }), 400)
         
         # Updates the place status
-        result = businesses.update_one( # Update the document
-            {
-                "_id": ObjectId(city_id), # Find city by ID
-                "places._id": ObjectId(place_id) # Find place by ID
-            },
+        result = places_collection.update_one( # Update the place document
+            place_query(city_id, place_id), # Find place by ID within the city
             {
-                "$set": {"places.$.info.status": status} # Update status in info object
+                "$set": {"info.status": status} # Update status in info object
             }
         )
         
@@ -1289,6 +2950,7 @@ def update_place_status(city_id, place_id): # Function to update place status
 ''''''
 # Gets all reviews for a specific food place
 @app.route("/api/cities/<city_id>/places/<place_id>/reviews", methods=["GET"]) 
+@cached_response
 def show_all_reviews(city_id, place_id): 
     try: 
         # Validates IDs format
@@ -1305,36 +2967,8 @@ def show_all_reviews(city_id, place_id):
         )
         page_start = (page_size * (page_num - 1)) # Calculate pagination start point
 
-        # Sets up aggregation pipeline
-        pipeline = [ # Initialize pipeline stages
-            { # Match the specific city
-                "$match": {
-                    "_id": ObjectId(city_id) # Find by city ID
-                }
-            },
-            { # Unwind places array
-                "$unwind": "$places"
-            },
-            { # Match specific place
-                "$match": {
-                    "places._id": ObjectId(place_id) # Find by place ID
-                }
-            },
-            { # Unwind reviews array
-                "$unwind": "$places.ratings.recent_reviews"
-            },
-            { # Project review fields
-                "$project": {
-                    "review_id": "$places.ratings.recent_reviews.review_id",
-                    "rating": "$places.ratings.recent_reviews.rating",
-                    "author_name": "$places.ratings.recent_reviews.author_name",
-                    "content": "$places.ratings.recent_reviews.content",
-                    "date_posted": "$places.ratings.recent_reviews.date_posted",
-                    "language": "$places.ratings.recent_reviews.language",
-                    "_id": { "$toString": "$places.ratings.recent_reviews._id" }
-                }
-            }
-        ]
+        # Sets up query on the reviews collection
+        query = review_query(city_id, place_id) # Reviews of this place
 
         # Adds rating filter if provided
         min_rating = request.args.get('min_rating') # Get rating parameter
@@ -1343,30 +2977,18 @@ def show_all_reviews(city_id, place_id):
                 min_rating_value = float(min_rating) # Convert to float
                 if not 0 <= min_rating_value <= 5: # Validate rating range
                     return make_response(jsonify({"error": "Rating must be between 0 and 5"}), 400)
-                pipeline.append({ # Add rating filter
-                    "$match": {
-                        "rating": {"$gte": min_rating_value} # Match minimum rating
-                    }
-                })
+                query["rating"] = {"$gte": min_rating_value} # Match minimum rating
             except ValueError: # If conversion fails
                 return make_response(jsonify({"error": "Invalid rating format"}), 400)
 
         # Adds date filters if provided
         start_date = request.args.get('start_date') # Get start date parameter
         if start_date: # If start date provided
-            pipeline.append({ # Add start date filter
-                "$match": {
-                    "date_posted": {"$gte": start_date}
-                }
-            })
+            query.setdefault("date_posted", {})["$gte"] = start_date # Add start date filter
 
         end_date = request.args.get('end_date') # Get end date parameter
         if end_date: # If end date provided
-            pipeline.append({ # Add end date filter
-                "$match": {
-                    "date_posted": {"$lte": end_date}
-                }
-            })
+            query.setdefault("date_posted", {})["$lte"] = end_date # Add end date filter
 
         # Adds sorting stage
         valid_sort_fields = ['date_posted', 'rating'] # Define valid sort fields
@@ -1377,30 +2999,32 @@ def show_all_reviews(city_id, place_id):
         sort_order = request.args.get('sort_order', 'desc').lower() # Get sort order or default
         sort_direction = -1 if sort_order == 'desc' else 1 # Convert to MongoDB sort value
 
-        # Adds sort and pagination
-        pipeline.extend([ # Add final stages
-            {"$sort": {sort_field: sort_direction}}, # Sort reviews
-            {"$skip": page_start}, # Skip to page start
-            {"$limit": page_size} # Limit results
-        ])
-
-        # Executes pipeline
-        reviews = list(businesses.aggregate(pipeline)) # Run aggregation
-        
-        # Gets total count for pagination
-        count_pipeline = pipeline[:-2] # Remove pagination stages
-        count_pipeline.append({"$count": "total"}) # Add count stage
-        total_count = list(businesses.aggregate(count_pipeline)) # Get total count
-        total_reviews = total_count[0]['total'] if total_count else 0 # Extract count
+        # Continues after the cursor if provided, otherwise skips to the page number
+        cursor = request.args.get('cursor') # Opaque cursor from the previous page
+        try: # Cursor comes from the client
+            after = cursor_condition(cursor, sort_field, sort_direction) if cursor else None
+        except ValueError: # If cursor malformed
+            return make_response(jsonify({"error": "Invalid cursor"}), 400)
+        include_total = request.args.get('include_total', 'true').lower() != 'false' # Total can be skipped
+
+        # Executes indexed query with sorting, pagination and total count in one round trip
+        results, total_reviews, more_reviews = find_page( # Sort and page come straight from the index
+            reviews_collection, query,
+            [(sort_field, sort_direction), ("_id", sort_direction)],
+            0 if cursor else page_start, page_size,
+            after=after, projection=REVIEW_PROJECTION, include_total=include_total
+        )
+        reviews = results # IDs are converted by the JSON provider
 
         # Returns response
         response_data = { # Create response object
             'reviews': reviews, # List of reviews
             'pagination': { # Pagination information
-                'current_page': page_num, # Current page number
-                'total_pages': (total_reviews + page_size - 1) // page_size, # Total pages
+                'current_page': None if cursor else page_num, # Current page number, unknown when paging by cursor
+                'total_pages': (total_reviews + page_size - 1) // page_size if total_reviews is not None else None, # Total pages
                 'page_size': page_size, # Items per page
-                'total_items': total_reviews # Total reviews count
+                'total_items': total_reviews, # Total reviews count
+                'next_cursor': next_page_cursor(results, sort_field, more_reviews) # Cursor for the next page
             },
             'filters_applied': { # Applied filters
                 'min_rating': float(min_rating) if min_rating else None,
@@ -1437,52 +3061,16 @@ def show_one_review(city_id, place_id, review_id): # Function to show single rev
         if not ObjectId.is_valid(review_id): # Check if review ID is valid
             return make_response(jsonify({"error": "Invalid review ID format"}), 200)
 
-        # Sets up aggregation pipeline
-        pipeline = [ # Initialize pipeline stages
-            { # Match the specific city
-                "$match": {
-                    "_id": ObjectId(city_id) # Find by city ID
-                }
-            },
-            { # Unwind places array
-                "$unwind": "$places"
-            },
-            { # Match specific place
-                "$match": {
-                    "places._id": ObjectId(place_id) # Find by place ID
-                }
-            },
-            { # Unwind reviews array
-                "$unwind": "$places.ratings.recent_reviews"
-            },
-            { # Match specific review
-                "$match": {
-                    "places.ratings.recent_reviews._id": ObjectId(review_id) # Find by review ID
-                }
-            },
-            { # Project review fields
-                "$project": {
-                    "review_id": "$places.ratings.recent_reviews.review_id",
-                    "rating": "$places.ratings.recent_reviews.rating",
-                    "author_name": "$places.ratings.recent_reviews.author_name",
-                    "content": "$places.ratings.recent_reviews.content",
-                    "date_posted": "$places.ratings.recent_reviews.date_posted",
-                    "language": "$places.ratings.recent_reviews.language",
-                    "_id": { "$toString": "$places.ratings.recent_reviews._id" }
-                }
-            }
-        ]
-
-        # Executes pipeline
-        result = list(businesses.aggregate(pipeline)) # Run aggregation
+        # Finds the review by ID
+        review = reviews_collection.find_one( # Single lookup on _id
+            review_query(city_id, place_id, review_id),
+            REVIEW_PROJECTION
+        )
         
         # Checks if review was found
-        if not result: # If no review found
+        if not review: # If no review found
             return make_response(jsonify({"error": "Review not found"}), 404)
 
-        # Gets review data
-        review = result[0] # Get first (and only) result
-        
         # Returns the review
         return make_response(jsonify({ # Create JSON response
             "data": review, # Review details
@@ -1500,6 +3088,7 @@ def show_one_review(city_id, place_id, review_id): # Function to show single rev
 # Adds a new review
 @app.route("/api/cities/<city_id>/places/<place_id>/reviews", methods=["POST"]) # Route to add review
 #@jwt_required # Requires valid token
+@invalidates_cache()
 def add_new_review(city_id, place_id): # Function to add review
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
@@ -1547,65 +3136,34 @@ def add_new_review(city_id, place_id): # Function to add review
             "language": review_data.get('language', 'en')
         }
 
-        result = businesses.update_one( # Add review to place
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$push": {
-                    "places.$.ratings.recent_reviews": new_review
-                }
-            }
+        reviews_collection.insert_one( # Store the review first, so the place totals never count a review that isn't stored
+            dict(new_review, place_id=ObjectId(place_id), city_id=ObjectId(city_id))
         )
 
+        try:
+            result = places_collection.update_one( # Add review to recent reviews and update totals in one write
+                place_query(city_id, place_id),
+                rating_update(rating, 1, {"$slice": [ # Keep only the latest reviews on the place
+                    {"$concatArrays": [RECENT_REVIEWS, {"$literal": [new_review]}]},
+                    -RECENT_REVIEWS_LIMIT
+                ]})
+            )
+        except Exception: # Totals unchanged, take the review back out
+            reviews_collection.delete_one({"_id": new_review["_id"]})
+            raise
+
         if result.matched_count == 0: # Check if place exists
+            reviews_collection.delete_one({"_id": new_review["_id"]}) # No place to add it to
             return make_response(jsonify({
                 "error": "City or place not found"
             }), 404)
             
         if result.modified_count == 0: # Check if update worked
+            reviews_collection.delete_one({"_id": new_review["_id"]}) # Totals unchanged
             return make_response(jsonify({
                 "error": "Failed to add review"
             }), 500)
 
-        businesses.update_one( # Update review count
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$inc": {
-                    "places.$.ratings.review_count": 1
-                }
-            }
-        )
-
-        pipeline = [ # Calculate new rating
-            {"$match": {"_id": ObjectId(city_id)}},
-            {"$unwind": "$places"},
-            {"$match": {"places._id": ObjectId(place_id)}},
-            {"$unwind": "$places.ratings.recent_reviews"},
-            {"$group": {
-                "_id": None,
-                "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-            }}
-        ]
-        
-        avg_result = list(businesses.aggregate(pipeline)) # Get new average
-        if avg_result: # Update average rating
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                    }
-                }
-            )
-
         return make_response(jsonify({ # Return success
             "message": "Review added successfully",
             "review": {
@@ -1621,8 +3179,26 @@ def add_new_review(city_id, place_id): # Function to add review
             "message": str(err)
         }), 500)
 
+# Imports many reviews for many places from an NDJSON body, one review per line
+@app.route("/api/reviews/import", methods=["POST"])
+#@jwt_required
+#@admin_required
+def bulk_import_reviews(): # Function to import reviews
+    try:
+        try: # Batch size comes from the client
+            batch_size = min(max(int(request.args.get('batch_size', app.config['IMPORT_BATCH_SIZE'])), 1), 5000)
+        except ValueError: # If batch size not a number
+            return make_response(jsonify({"error": "batch_size must be a number"}), 400)
+        report = import_reviews(request.stream, batch_size) # Reads the body line by line
+        return make_response(jsonify(report), 200)
+
+    except Exception as err: # Handle any errors
+        print(f"Error occurred: {err}")
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
+
 @app.route("/api/cities/<city_id>/places/<place_id>/reviews/<review_id>", methods=["PUT"]) # Route to update review
 #@jwt_required # Requires valid token
+@invalidates_cache()
 def update_review(city_id, place_id, review_id): # Function to update review
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
@@ -1652,64 +3228,43 @@ def update_review(city_id, place_id, review_id): # Function to update review
         update_fields = {} 
         
         if 'rating' in review_data: # Add rating if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].rating'] = rating
+            update_fields['rating'] = rating
             
         if 'content' in review_data: # Add content if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].content'] = review_data['content']
+            update_fields['content'] = review_data['content']
             
         if 'author_name' in review_data: # Add author if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].author_name'] = review_data['author_name']
+            update_fields['author_name'] = review_data['author_name']
             
         # Update timestamp
-        update_fields['places.$.ratings.recent_reviews.$[review].date_posted'] = \
-            datetime.datetime.now(datetime.UTC).isoformat()
+        update_fields['date_posted'] = datetime.datetime.now(datetime.UTC).isoformat()
         
-        # Update the review
-        result = businesses.update_one(
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
+        # Update the review, keeping the old version to work out the rating change
+        old_review = reviews_collection.find_one_and_update(
+            review_query(city_id, place_id, review_id),
             {"$set": update_fields},
-            array_filters=[{"review._id": ObjectId(review_id)}]
+            projection={"rating": 1},
+            return_document=ReturnDocument.BEFORE
         )
         
-        if result.matched_count == 0: # Check if found
+        if old_review is None: # Check if found
             return make_response(jsonify({
-                "error": "City or place not found"
-            }), 404)
-            
-        if result.modified_count == 0: # Check if updated
-            return make_response(jsonify({
-                "error": "Review not found or no changes made"
+                "error": "Review not found"
             }), 404)
-            
-        # Update average rating if rating changed
-        if 'rating' in review_data: # Recalculate if rating changed
-            pipeline = [ # Calculate new rating
-                {"$match": {"_id": ObjectId(city_id)}},
-                {"$unwind": "$places"},
-                {"$match": {"places._id": ObjectId(place_id)}},
-                {"$unwind": "$places.ratings.recent_reviews"},
-                {"$group": {
-                    "_id": None,
-                    "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-                }}
-            ]
-            
-            avg_result = list(businesses.aggregate(pipeline)) # Get new average
-            if avg_result: # Update average rating
-                businesses.update_one(
-                    {
-                        "_id": ObjectId(city_id),
-                        "places._id": ObjectId(place_id)
-                    },
-                    {
-                        "$set": {
-                            "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                        }
-                    }
-                )
+
+        # Update the recent reviews copy and the rating totals in one write
+        rating_change = rating - old_review.get('rating', 0) if 'rating' in review_data else 0 # Difference in rating
+        places_collection.update_one(
+            place_query(city_id, place_id),
+            rating_update(rating_change, 0, {"$map": { # Replace fields of the matching recent review
+                "input": RECENT_REVIEWS,
+                "in": {"$cond": [
+                    {"$eq": ["$$this._id", ObjectId(review_id)]},
+                    {"$mergeObjects": ["$$this", {"$literal": update_fields}]},
+                    "$$this"
+                ]}
+            }})
+        )
             
         return make_response(jsonify({"message": "Review updated successfully"}), 200)
         
@@ -1724,6 +3279,7 @@ def update_review(city_id, place_id, review_id): # Function to update review
 @app.route("/api/cities/<city_id>/places/<place_id>/reviews/<review_id>", methods=["DELETE"]) # Route to delete review
 #@jwt_required # Requires valid token
 #@admin_required # Requires admin privileges
+@invalidates_cache()
 def delete_review(city_id, place_id, review_id): # Function to delete review
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
@@ -1733,76 +3289,38 @@ def delete_review(city_id, place_id, review_id): # Function to delete review
         if not ObjectId.is_valid(review_id): # Check if review ID is valid
             return make_response(jsonify({"error": "Invalid review ID format"}), 400)
             
-        # Remove the review
-        result = businesses.update_one(
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$pull": {
-                    "places.$.ratings.recent_reviews": {
-                        "_id": ObjectId(review_id)
-                    }
-                }
-            }
+        # Remove the review, keeping it to know its rating
+        old_review = reviews_collection.find_one_and_delete(
+            review_query(city_id, place_id, review_id),
+            projection={"rating": 1}
         )
         
-        if result.matched_count == 0: # Check if place exists
-            return make_response(jsonify({"error": "City or place not found"}), 404)
-        if result.modified_count == 0: # Check if review was deleted
+        if old_review is None: # Check if review was deleted
             return make_response(jsonify({"error": "Review not found"  }), 404)
             
-        # Update review count
-        businesses.update_one(
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$inc": {
-                    "places.$.ratings.review_count": -1
-                }
-            }
+        # Latest stored reviews, to refill recent reviews if the deleted one was there
+        latest = list(reviews_collection.find( # Uses the place_date index
+            review_query(city_id, place_id), {"place_id": 0, "city_id": 0}
+        ).sort([("date_posted", DESCENDING), ("_id", DESCENDING)]).limit(RECENT_REVIEWS_LIMIT))
+
+        # Remove the copy from recent reviews, refill it and update the rating totals in one write
+        places_collection.update_one(
+            place_query(city_id, place_id),
+            rating_update(-old_review.get('rating', 0), -1, {"$slice": [
+                {"$sortArray": {"input": {"$concatArrays": [
+                    {"$filter": { # Recent reviews without the deleted one
+                        "input": RECENT_REVIEWS,
+                        "cond": {"$ne": ["$$this._id", ObjectId(review_id)]}
+                    }},
+                    {"$filter": { # Latest stored reviews not already there
+                        "input": {"$literal": latest},
+                        "as": "review",
+                        "cond": {"$not": [{"$in": ["$$review._id", {"$map": {"input": RECENT_REVIEWS, "in": "$$this._id"}}]}]}
+                    }}
+                ]}, "sortBy": {"date_posted": 1}}}, # Oldest first
+                -RECENT_REVIEWS_LIMIT
+            ]})
         )
-        
-        # Recalculate average rating
-        pipeline = [ # Calculate new rating
-            {"$match": {"_id": ObjectId(city_id)}},
-            {"$unwind": "$places"},
-            {"$match": {"places._id": ObjectId(place_id)}},
-            {"$unwind": "$places.ratings.recent_reviews"},
-            {"$group": {
-                "_id": None,
-                "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-            }}
-        ]
-        
-        avg_result = list(businesses.aggregate(pipeline)) # Get new average
-        if avg_result: # Update average rating
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                    }
-                }
-            )
-        else: # If no reviews left
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": 0
-                    }
-                }
-            )  
         return make_response(jsonify({ # Return success
             "message": "Review deleted successfully"
         }), 200)
@@ -1817,6 +3335,7 @@ def delete_review(city_id, place_id, review_id): # Function to delete review
 # Update place rating
 @app.route("/api/cities/<city_id>/places/<place_id>/update-rating", methods=["POST"]) # Route to update rating
 #@jwt_required # Requires valid token
+@invalidates_cache()
 def update_place_rating(city_id, place_id): # Function to update place rating
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
@@ -1827,32 +3346,29 @@ def update_place_rating(city_id, place_id): # Function to update place rating
 
         # Calculate new rating
         pipeline = [ # Aggregation pipeline
-            {"$match": {"_id": ObjectId(city_id)}}, # Match city
-            {"$unwind": "$places"}, # Unwind places
-            {"$match": {"places._id": ObjectId(place_id)}}, # Match place
-            {"$unwind": "$places.ratings.recent_reviews"}, # Unwind reviews
+            {"$match": review_query(city_id, place_id)}, # Match the place's reviews
             {
                 "$group": { # Group and calculate
-                    "_id": "$places._id", # Group by place
-                    "average_rating": {"$avg": "$places.ratings.recent_reviews.rating"}, # Average rating
+                    "_id": "$place_id", # Group by place
+                    "average_rating": {"$avg": "$rating"}, # Average rating
+                    "rating_sum": {"$sum": "$rating"}, # Sum of ratings
                     "review_count": {"$sum": 1} # Count reviews
                 }
             }
         ]
 
-        result = list(businesses.aggregate(pipeline)) # Run pipeline
+        result = list(reviews_collection.aggregate(pipeline)) # Run pipeline
         
         if result: # If reviews exist
             # Update place ratings
-            update_result = businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
+            update_result = places_collection.update_one(
+                place_query(city_id, place_id),
                 {
                     "$set": {
-                        "places.$.ratings.average_rating": round(result[0]['average_rating'], 1),
-                        "places.$.ratings.review_count": result[0]['review_count']
+                        "ratings.average_rating": round(result[0]['average_rating'], 1),
+                        "ratings.rating_sum": result[0]['rating_sum'],
+                        "ratings.review_count": result[0]['review_count'],
+                        "ratings.score": bayesian_score(result[0]['rating_sum'], result[0]['review_count'])
                     }
                 }
             )
@@ -1871,15 +3387,14 @@ def update_place_rating(city_id, place_id): # Function to update place rating
             
         else: # If no reviews
             # Reset ratings to zero
-            update_result = businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
+            update_result = places_collection.update_one(
+                place_query(city_id, place_id),
                 {
                     "$set": {
-                        "places.$.ratings.average_rating": 0,
-                        "places.$.ratings.review_count": 0
+                        "ratings.average_rating": 0,
+                        "ratings.rating_sum": 0,
+                        "ratings.review_count": 0,
+                        "ratings.score": bayesian_score(0, 0)
                     }
                 }
             )
@@ -1900,5 +3415,90 @@ def update_place_rating(city_id, place_id): # Function to update place rating
         print(f"Error occurred: {err}")
         return make_response(jsonify({"error": "Server error","message": str(err)}), 500)
 
+''''''
+# Cache route
+''''''
+# Cache counters
+@app.route("/api/cache/stats", methods=["GET"])
+def show_cache_stats(): # Function to show cache counters
+    return make_response(jsonify(response_cache.info()), 200)
+
+''''''
+# Commands
+''''''
+# Creates the declared indexes and reports drift
+@app.cli.command("create-indexes")
+def create_indexes_command(): # Run with: flask --app app create-indexes
+    create_indexes()
+
+# Moves places embedded in city documents into the places collection
+@app.cli.command("migrate-places")
+def migrate_places(): # Run with: flask --app app migrate-places
+    moved = 0 # Number of places moved
+    for city in businesses.find({"places": {"$exists": True}}): # Cities still holding places
+        operations = [] # Bulk write operations for this city
+        for place in city.get("places", []): # For each embedded place
+            place.setdefault("_id", ObjectId()) # Places without an ID get a new one
+            place["city_id"] = city["_id"] # Link place to the city
+            set_derived_fields(place) # Geo point and opening intervals
+            split_place_reviews(place) # Move reviews to the reviews collection
+            operations.append(ReplaceOne({"_id": place["_id"]}, place, upsert=True)) # Safe to re-run
+        if operations: # If city had places
+            places_collection.bulk_write(operations, ordered=False)
+            moved += len(operations)
+        businesses.update_one({"_id": city["_id"]}, {"$unset": {"places": ""}}) # Remove embedded array
+    create_indexes() # Make sure the new collection is indexed
+    print(f"Moved {moved} places into the places collection")
+
+# Moves reviews still embedded in places into the reviews collection
+@app.cli.command("migrate-reviews")
+def migrate_reviews(): # Run with: flask --app app migrate-reviews
+    moved = 0 # Number of places processed
+    for place in places_collection.find({"ratings.recent_reviews.0": {"$exists": True}}): # Places with reviews
+        split_place_reviews(place) # Copy reviews and trim the embedded list
+        places_collection.update_one( # Keep only the latest reviews and the running sum on the place
+            {"_id": place["_id"]},
+            {"$set": {"ratings": place["ratings"]}}
+        )
+        moved += 1
+    create_indexes() # Make sure the reviews collection is indexed
+    print(f"Moved reviews of {moved} places into the reviews collection")
+
+# Recomputes the derived fields of every place, run after adding a derived field
+@app.cli.command("derive-places")
+def derive_places(): # Run with: flask --app app derive-places
+    operations = [] # Bulk write operations
+    for place in places_collection.find({}): # Every place
+        operations.append(UpdateOne({"_id": place["_id"]}, derived_fields_update(place)))
+        if len(operations) == 1000: # Write in batches
+            places_collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations: # Last batch
+        places_collection.bulk_write(operations, ordered=False)
+    create_indexes() # Make sure the derived fields are indexed
+    print("Derived fields recomputed for all places")
+
+# Imports places into a city from an NDJSON file, use - for stdin
+@app.cli.command("import-places")
+@click.argument("city_id")
+@click.argument("source", type=click.File("rb"))
+@click.option("--batch-size", default=None, type=int, help="Places per bulk write")
+def import_places_command(city_id, source, batch_size): # Run with: flask --app app import-places <city_id> places.ndjson
+    ensure_indexes() # Re-imported reviews are matched through place_review_id
+    if not ObjectId.is_valid(city_id) or not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1):
+        raise click.BadParameter("City not found", param_hint="city_id")
+    report = import_places(ObjectId(city_id), source, max(batch_size or app.config['IMPORT_BATCH_SIZE'], 1))
+    print(json.dumps(report, indent=2))
+
+# Imports reviews for many places from an NDJSON file, use - for stdin
+@app.cli.command("import-reviews")
+@click.argument("source", type=click.File("rb"))
+@click.option("--batch-size", default=None, type=int, help="Reviews per bulk write")
+def import_reviews_command(source, batch_size): # Run with: flask --app app import-reviews reviews.ndjson
+    ensure_indexes()
+    report = import_reviews(source, max(batch_size or app.config['IMPORT_BATCH_SIZE'], 1))
+    print(json.dumps(report, indent=2))
+
 if __name__ == "__main__":
+    ensure_indexes() # Fail at startup rather than on the first request
     app.run(debug = True, port = 2000)
\ No newline at end of file
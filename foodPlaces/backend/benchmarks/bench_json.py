@@ -0,0 +1,79 @@
+''''''
+# JSON encoding micro-benchmark: the old convert_objectid_to_str + jsonify path against MongoJSONProvider,
+# with the json module and with orjson when it is installed. No database needed.
+# Run from the backend folder with: python benchmarks/bench_json.py [places] [repeats]
+''''''
+import datetime
+import os
+import sys
+import timeit
+
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Backend folder, where app.py is
+import app as backend
+
+# The converter responses went through before MongoJSONProvider
+def convert_objectid_to_str(document):
+    if isinstance(document, list): # If it's a list, process each item
+        return [convert_objectid_to_str(item) for item in document]
+    elif isinstance(document, dict): # If it's a dict, process each key-value pair
+        return {
+            key: convert_objectid_to_str(value) if isinstance(value, (dict, list)) else str(value) if isinstance(value, ObjectId) else value
+            for key, value in document.items()
+        }
+    else:
+        return document # Return the original value if not a dict or list
+
+# A place shaped like the ones the places routes return
+def make_place(i):
+    return {
+        "_id": ObjectId(),
+        "city_id": ObjectId(),
+        "place_id": f"place_{i:05d}",
+        "info": {"name": f"Place {i}", "type": ["cafe", "bakery"], "status": "open"},
+        "location": {
+            "address": {"street": f"{i} Main Street", "city": "Belfast", "postcode": "BT1 1AA"},
+            "coordinates": {"latitude": 54.597, "longitude": -5.93}
+        },
+        "business_hours": {day: {"open": "09:00", "close": "17:00"} for day in
+                           ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]},
+        "service_options": {"dining": {"dine_in": True, "takeaway": False}, "meals": {"breakfast": True}},
+        "ratings": {
+            "average_rating": 4.2,
+            "review_count": 10,
+            "recent_reviews": [{
+                "_id": ObjectId(),
+                "review_id": f"rev_{i:03d}{k}",
+                "rating": 4.0,
+                "author_name": "Reviewer",
+                "content": "Lovely coffee and friendly staff.",
+                "date_posted": datetime.datetime(2024, 5, k + 1, tzinfo=datetime.UTC).isoformat()
+            } for k in range(3)]
+        }
+    }
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000 # Places per response
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20 # Encodings timed per path
+    body = {"places": [make_place(i) for i in range(count)]}
+    plain = DefaultJSONProvider(backend.app) # Flask's own encoder, as jsonify used it
+    orjson = backend.orjson
+    paths = {"convert_objectid_to_str + json": lambda: plain.dumps(convert_objectid_to_str(body))}
+    with backend.app.app_context():
+        backend.orjson = None # Provider with the json module
+        paths["MongoJSONProvider + json"] = lambda: backend.app.json.dumps(body)
+        results = {name: timeit.timeit(encode, number=repeats) / repeats for name, encode in paths.items()}
+        if orjson is not None: # Provider with orjson
+            backend.orjson = orjson
+            results["MongoJSONProvider + orjson"] = timeit.timeit(lambda: backend.app.json.dumps(body), number=repeats) / repeats
+    baseline = results["convert_objectid_to_str + json"]
+    print(f"{count} places, mean of {repeats} encodings")
+    for name, seconds in results.items():
+        print(f"{name:34} {seconds * 1000:8.2f} ms  {baseline / seconds:5.2f}x")
+    if orjson is None:
+        print("orjson is not installed, pip install orjson to time it")
+
+if __name__ == "__main__":
+    main()
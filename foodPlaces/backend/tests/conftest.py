@@ -0,0 +1,42 @@
+import os
+import sys
+import uuid
+
+import pytest
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Backend folder, where app.py is
+
+# The tests run against the same MongoDB as the app and clean up what they create
+@pytest.fixture(scope="session")
+def app_module():
+    try: # Skip rather than hang when no server is running
+        MongoClient("mongodb://127.0.0.1:27017", serverSelectionTimeoutMS=1000).admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB is not running on 127.0.0.1:27017")
+    import app
+    return app
+
+# Test client for one thread, Flask test clients shouldn't be shared between threads
+@pytest.fixture
+def client_factory(app_module):
+    return app_module.app.test_client
+
+# A city with one place that has no reviews, removed with its reviews afterwards
+@pytest.fixture
+def place(app_module):
+    city_oid, place_oid = ObjectId(), ObjectId()
+    app_module.businesses.insert_one({"_id": city_oid, "city_id": f"test_{uuid.uuid4().hex[:8]}", "city_name": "Test City"})
+    app_module.places_collection.insert_one({
+        "_id": place_oid,
+        "city_id": city_oid,
+        "place_id": f"test_{uuid.uuid4().hex[:8]}",
+        "info": {"name": "Test Place", "type": ["cafe"], "status": "open"},
+        "ratings": {"average_rating": 0, "rating_sum": 0, "review_count": 0, "recent_reviews": []}
+    })
+    yield str(city_oid), str(place_oid)
+    app_module.reviews_collection.delete_many({"place_id": place_oid})
+    app_module.places_collection.delete_one({"_id": place_oid})
+    app_module.businesses.delete_one({"_id": city_oid})
@@ -0,0 +1,59 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Usernames and emails made by a test, removed afterwards
+@pytest.fixture
+def unique_name(app_module):
+    prefix = f"test_{uuid.uuid4().hex[:8]}"
+    yield prefix
+    app_module.users.delete_many({"username": {"$regex": f"^{prefix}"}})
+    app_module.users.delete_many({"email": {"$regex": f"^{prefix}"}})
+
+# Rate limits and bcrypt cost out of the way, the tests are about uniqueness
+@pytest.fixture(autouse=True)
+def fast_register(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, "BCRYPT_ROUNDS", 4)
+    monkeypatch.setattr(app_module, "ip_limiter", app_module.TokenBucketLimiter(1000, 1000, 100))
+    monkeypatch.setattr(app_module, "username_limiter", app_module.TokenBucketLimiter(1000, 1000, 100))
+
+def register_in_parallel(client_factory, bodies):
+    with ThreadPoolExecutor(max_workers=len(bodies)) as pool:
+        return list(pool.map(lambda body: client_factory().post("/api/register", json=body).status_code, bodies))
+
+# The same username sent at once from many clients makes one user
+def test_parallel_duplicate_usernames_make_one_user(app_module, client_factory, unique_name):
+    bodies = [
+        {"username": unique_name, "password": "secret1", "email": f"{unique_name}_{i}@test.com", "name": "Tester"}
+        for i in range(12)
+    ]
+    statuses = register_in_parallel(client_factory, bodies)
+    assert statuses.count(201) == 1
+    assert statuses.count(409) == len(bodies) - 1
+    assert app_module.users.count_documents({"username": unique_name}) == 1
+
+# The same email sent at once under different usernames makes one user
+def test_parallel_duplicate_emails_make_one_user(app_module, client_factory, unique_name):
+    email = f"{unique_name}@test.com"
+    bodies = [
+        {"username": f"{unique_name}_{i}", "password": "secret1", "email": email, "name": "Tester"}
+        for i in range(12)
+    ]
+    statuses = register_in_parallel(client_factory, bodies)
+    assert statuses.count(201) == 1
+    assert statuses.count(409) == len(bodies) - 1
+    assert app_module.users.count_documents({"email": email}) == 1
+
+# Registration is refused rather than risking duplicates when the unique indexes can't be built
+def test_register_refused_without_unique_indexes(app_module, client_factory, unique_name, monkeypatch):
+    def create_indexes():
+        raise RuntimeError("Required index users.username_unique could not be built")
+    monkeypatch.setattr(app_module, "create_indexes", create_indexes)
+    monkeypatch.setattr(app_module, "indexes_ready", threading.Event()) # As in a process that hasn't built them yet
+    response = client_factory().post("/api/register", json={
+        "username": unique_name, "password": "secret1", "email": f"{unique_name}@test.com", "name": "Tester"
+    })
+    assert response.status_code == 503
+    assert app_module.users.count_documents({"username": unique_name}) == 0
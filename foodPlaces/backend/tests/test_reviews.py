@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+
+# Adds, updates and deletes reviews of one place from many threads at once
+def test_concurrent_review_writes_keep_totals_exact(app_module, client_factory, place):
+    city_id, place_id = place
+    url = f"/api/cities/{city_id}/places/{place_id}/reviews"
+
+    def add(rating):
+        response = client_factory().post(url, json={"rating": rating, "author_name": "tester", "content": "text"})
+        assert response.status_code == 201
+        return response.get_json()["review"]["id"]
+
+    def update(review_id, rating):
+        response = client_factory().put(f"{url}/{review_id}", json={"rating": rating})
+        assert response.status_code == 200
+
+    def delete(review_id):
+        response = client_factory().delete(f"{url}/{review_id}")
+        assert response.status_code == 200
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        review_ids = list(pool.map(add, [1 + i % 5 for i in range(40)]))
+    with ThreadPoolExecutor(max_workers=16) as pool: # Every kind of write at the same time
+        futures = [pool.submit(add, 1 + i % 5) for i in range(20)]
+        futures += [pool.submit(update, review_id, 5) for review_id in review_ids[:15]]
+        futures += [pool.submit(delete, review_id) for review_id in review_ids[15:25]]
+        for future in futures:
+            future.result()
+
+    totals = list(app_module.reviews_collection.aggregate([
+        {"$match": {"place_id": ObjectId(place_id)}},
+        {"$group": {"_id": None, "rating_sum": {"$sum": "$rating"}, "review_count": {"$sum": 1}}}
+    ]))[0]
+    ratings = app_module.places_collection.find_one({"_id": ObjectId(place_id)})["ratings"]
+    assert ratings["review_count"] == totals["review_count"] == 50
+    assert ratings["rating_sum"] == totals["rating_sum"]
+    assert ratings["average_rating"] == round(totals["rating_sum"] / totals["review_count"], 1)
+    assert len(ratings["recent_reviews"]) == app_module.RECENT_REVIEWS_LIMIT
+
+# A review for a place that doesn't exist leaves nothing behind
+def test_review_for_missing_place_is_not_stored(app_module, client_factory, place):
+    city_id, _ = place
+    missing = str(ObjectId())
+    response = client_factory().post(
+        f"/api/cities/{city_id}/places/{missing}/reviews",
+        json={"rating": 4, "author_name": "tester", "content": "text"}
+    )
+    assert response.status_code == 404
+    assert app_module.reviews_collection.count_documents({"place_id": ObjectId(missing)}) == 0